@@ -1,21 +1,136 @@
-def tanh(x):
-    return np.tanh(x)
+import numpy as np
+import inspect, time, json, struct, warnings
 
 
-def tanh_grad(x):
-    return 1 - np.tanh(x) ** 2
+def identity(x, out=None):
+    if out is None:
+        return x
+    np.copyto(out, x)
+    return out
+
+
+def identity_grad(x, out=None):
+    return 1
+
+
+def tanh(x, out=None):
+    return np.tanh(x, out=out)
+
+
+def tanh_grad(x, out=None):
+    out = np.tanh(x, out=out)
+    np.square(out, out=out)
+    return np.subtract(1, out, out=out)
+
+
+def relu(x, out=None):
+    return np.maximum(x, 0, out=out)
+
+
+def relu_grad(x, out=None):
+    if out is None:
+        return (x > 0).astype(x.dtype)
+    return np.greater(x, 0, out=out)
+
+
+def sigmoid(x, out=None):
+    out = np.negative(x, out=out)
+    np.exp(out, out=out)
+    out += 1
+    return np.reciprocal(out, out=out)
+
+
+def sigmoid_grad(x, out=None):
+    out = sigmoid(x, out=out)
+    return np.multiply(out, 1 - out, out=out)
+
+
+# Activations by name, so a model can be saved and rebuilt (lambdas cannot be pickled or written to a file).
+ACTIVATIONS = {
+    "identity": (identity, identity_grad),
+    "tanh": (tanh, tanh_grad),
+    "relu": (relu, relu_grad),
+    "sigmoid": (sigmoid, sigmoid_grad),
+}
+
+
+def register_activation(name, activation, activation_grad):
+    ACTIVATIONS[name] = (activation, activation_grad)
+
+
+def softmax(x, out=None):
+    # Shift by the row max so exp never overflows.
+    out = np.subtract(x, x.max(axis=1, keepdims=True), out=out)
+    np.exp(out, out=out)
+    out /= out.sum(axis=1, keepdims=True)
+    return out
+
+
+def cross_entropy(logits, labels):
+    # Mean negative log-likelihood computed from the logits via log-sum-exp, so it stays finite.
+    shifted = logits - logits.max(axis=1, keepdims=True)
+    log_norm = np.log(np.exp(shifted).sum(axis=1))
+    return float(np.mean(log_norm - shifted[np.arange(len(labels)), labels]))
+
+
+def _supports_out(func):
+    # In-place (out=) evaluation is used when the activation allows it; plain lambdas fall back to a copy.
+    if isinstance(func, np.ufunc):
+        return True
+    try:
+        return "out" in inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+MAGIC = b"GSVNN\x01"
+ALIGNMENT = 64
 
 
 class NN():
-    def __init__(self,architecture, learning_rate=0.1, activation=lambda x: x, activation_grad=lambda x: 1):
+    def __init__(self,architecture, learning_rate=0.1, activation="identity", activation_grad=None, dtype=np.float64, loss="mse",
+                 weights=None, biases=None):
         '''This is a fully connected NN. The architecture is a list, 
-        with each element specifying the number of nodes in each layer'''
+        with each element specifying the number of nodes in each layer.
+        activation is a name from ACTIVATIONS (its gradient is looked up too) or a function with its
+        activation_grad. A function passed alone, as in the old NN(arch, lr, activation) form, still works:
+        a registered one gets its gradient from ACTIVATIONS, anything else keeps the old gradient of 1 with
+        a DeprecationWarning. Only named activations can be saved.
+        dtype sets the precision of the weights and of the training buffers (np.float32 halves memory traffic).
+        loss is "mse" (targets shaped like the output) or "cross_entropy": the last layer becomes a softmax
+        over arch[-1] classes and the targets are integer class ids, as produced by dataset.main.
+        weights/biases, if given, are used as-is instead of init_weights (see NN.load).'''
+        if loss not in ("mse", "cross_entropy"):
+            raise ValueError(f"Unknown loss: {loss}")
+        if isinstance(activation, str):
+            if activation not in ACTIVATIONS:
+                raise ValueError(f"Unknown activation: {activation}")
+            self.activation_name = activation
+            activation, activation_grad = ACTIVATIONS[activation]
+        else:
+            if activation_grad is None:
+                activation_grad = next((grad for func, grad in ACTIVATIONS.values() if func is activation), None)
+            if activation_grad is None:
+                warnings.warn("NN(architecture, learning_rate, activation) without activation_grad is deprecated; "
+                              "the gradient is taken as 1 as before. Pass activation_grad or use register_activation.",
+                              DeprecationWarning, stacklevel=2)
+                activation_grad = identity_grad
+            # Recognise registered functions passed directly, e.g. activation=tanh.
+            self.activation_name = next((name for name, pair in ACTIVATIONS.items() if pair == (activation, activation_grad)), None)
         self.arch = architecture
         self.num_layers = len(self.arch) - 1
         self.activation = activation
         self.activation_grad = activation_grad
         self.lr = learning_rate
-        self.init_weights()
+        self.dtype = np.dtype(dtype)
+        self.loss = loss
+        # What the first layer takes: "pixels" (flattened screenshots / 255) or "embeddings:<backbone>".
+        self.input_kind = "pixels"
+        if weights is None:
+            self.init_weights()
+        else:
+            self.weights, self.biases = list(weights), list(biases)
+        self._buffer_size = 0
         
         
     def init_weights(self):
@@ -23,8 +138,8 @@ class NN():
         self.weights = []
         self.biases= []
         for n in range(self.num_layers):
-            self.weights.append(np.random.random((self.arch[n], self.arch[n+1])))
-            self.biases.append(np.random.random((1, self.arch[n + 1])))
+            self.weights.append(np.random.random((self.arch[n], self.arch[n+1])).astype(self.dtype, copy=False))
+            self.biases.append(np.random.random((1, self.arch[n + 1])).astype(self.dtype, copy=False))
 
         
     def feed_forward(self, X):
@@ -35,27 +150,40 @@ class NN():
             z_n = np.dot(self.a_ns[-1], self.weights[n]) + self.biases[n]
             
             self.z_ns.append(z_n)
-            self.a_ns.append(self.activation(z_n))
+            if self.loss == "cross_entropy" and n == self.num_layers - 1:
+                self.a_ns.append(softmax(z_n))
+            else:
+                self.a_ns.append(self.activation(z_n))
 
         return self.a_ns[-1]
             
     def loss_func(self, X, y):
         feed_forward = self.feed_forward(X)
+        if self.loss == "cross_entropy":
+            return cross_entropy(self.z_ns[-1], self._labels(y))
         loss = np.mean((feed_forward - y) ** 2) * 0.5
         return loss
+
+    def _labels(self, y):
+        return np.asarray(y).reshape(-1).astype(np.intp, copy=False)
     
     
     def calc_layer_errors(self, X, y):
         feed_forward = self.feed_forward(X)
 
-        self.layer_errors = []
-        error_last_layer = (feed_forward - y) * self.activation_grad(self.z_ns[-1]) * 0.5
-        self.layer_errors.append(error_last_layer)
+        self.layer_errors = [None] * self.num_layers
+        if self.loss == "cross_entropy":
+            # Fused softmax + cross-entropy gradient w.r.t. the logits.
+            error_last_layer = feed_forward.copy()
+            error_last_layer[np.arange(len(feed_forward)), self._labels(y)] -= 1
+        else:
+            error_last_layer = (feed_forward - y) * self.activation_grad(self.z_ns[-1]) * 0.5
+        self.layer_errors[-1] = error_last_layer
 
 
         for i in range(self.num_layers - 2, -1, -1):
-            error = self.activation_grad(self.z_ns[i]) * np.dot(self.layer_errors[-1], self.weights[i+1].T)
-            self.layer_errors.insert(0, error)
+            error = self.activation_grad(self.z_ns[i]) * np.dot(self.layer_errors[i+1], self.weights[i+1].T)
+            self.layer_errors[i] = error
         return self.layer_errors
 
     def calc_grads(self, X, y):
@@ -80,4 +208,225 @@ class NN():
         for i in range(self.num_layers):
             self.biases[i] -= self.lr * self.biases_grad[i]
             self.weights[i] -= self.lr * self.weights_grad[i]
-    
\ No newline at end of file
+
+
+    def _allocate(self, batch_size):
+        '''Preallocate per-layer activation, pre-activation, error and gradient buffers for batches of up to batch_size rows.
+        Smaller (last) batches use views of the same buffers.'''
+        if batch_size <= self._buffer_size:
+            return
+        widths = self.arch[1:]
+        self._z = [np.empty((batch_size, w), dtype=self.dtype) for w in widths]
+        self._a = [np.empty((batch_size, w), dtype=self.dtype) for w in widths]
+        self._delta = [np.empty((batch_size, w), dtype=self.dtype) for w in widths]
+        self._grad_tmp = [np.empty((batch_size, w), dtype=self.dtype) for w in widths]
+        self._weights_grad = [np.empty_like(w) for w in self.weights]
+        self._biases_grad = [np.empty_like(b) for b in self.biases]
+        self._buffer_size = batch_size
+        self._act_out = _supports_out(self.activation)
+        self._grad_out = _supports_out(self.activation_grad)
+
+    def _forward(self, X):
+        '''Forward pass into the preallocated buffers. Returns the output activations (a view).'''
+        b = len(X)
+        a_prev = X
+        for n in range(self.num_layers):
+            z = self._z[n][:b]
+            np.dot(a_prev, self.weights[n], out=z)
+            z += self.biases[n]
+            a = self._a[n][:b]
+            if self.loss == "cross_entropy" and n == self.num_layers - 1:
+                softmax(z, out=a)
+            elif self._act_out:
+                self.activation(z, out=a)
+            else:
+                np.copyto(a, self.activation(z))
+            a_prev = a
+        return a_prev
+
+    def _apply_activation_grad(self, n, delta):
+        b = len(delta)
+        if self._grad_out:
+            grad = self.activation_grad(self._z[n][:b], out=self._grad_tmp[n][:b])
+        else:
+            grad = self.activation_grad(self._z[n][:b])
+        np.multiply(delta, grad, out=delta)
+
+    def accumulate_grads(self, X, y):
+        '''Forward and backward pass on a batch. Leaves the gradients *summed* over the rows in
+        self._weights_grad / self._biases_grad (so shards of one batch can be added together) and returns the summed loss.'''
+        X = np.asarray(X, dtype=self.dtype)
+        b = len(X)
+        self._allocate(b)
+        output = self._forward(X)
+
+        # Loss and output error from the same forward pass.
+        delta = self._delta[-1][:b]
+        if self.loss == "cross_entropy":
+            labels = self._labels(y)
+            rows = np.arange(b)
+            # Summed cross_entropy() from the logits, so a saturated softmax cannot give log(0).
+            loss = cross_entropy(self._z[-1][:b], labels) * b
+            np.copyto(delta, output)
+            delta[rows, labels] -= 1
+        else:
+            y = np.asarray(y, dtype=self.dtype)
+            np.subtract(output, y, out=delta)
+            loss = 0.5 * np.vdot(delta, delta) / delta.shape[1]
+            delta *= 0.5
+            self._apply_activation_grad(self.num_layers - 1, delta)
+
+        # All errors are computed before any weights change, as in calc_layer_errors.
+        for i in range(self.num_layers - 2, -1, -1):
+            delta = self._delta[i][:b]
+            np.dot(self._delta[i + 1][:b], self.weights[i + 1].T, out=delta)
+            self._apply_activation_grad(i, delta)
+
+        for i in range(self.num_layers):
+            a_in = X if i == 0 else self._a[i - 1][:b]
+            delta = self._delta[i][:b]
+            np.dot(a_in.T, delta, out=self._weights_grad[i])
+            np.sum(delta, axis=0, keepdims=True, out=self._biases_grad[i])
+        return float(loss)
+
+    def apply_grads(self, step):
+        for i in range(self.num_layers):
+            self._weights_grad[i] *= step
+            self.weights[i] -= self._weights_grad[i]
+            self._biases_grad[i] *= step
+            self.biases[i] -= self._biases_grad[i]
+
+    def train_step(self, X, y):
+        '''One gradient step on a batch, sharing a single forward pass between the loss and the backward pass.
+        Same update as back_prop (including its 0.5 error scaling), without per-call allocations. Returns the loss.'''
+        b = len(X)
+        loss = self.accumulate_grads(X, y)
+        self.apply_grads(self.lr / b)
+        return loss / b
+
+    def iter_batches(self, X, y, batch_size, shuffle=True, rng=None):
+        '''Yield (X_batch, y_batch) mini-batches gathered into a reused buffer.'''
+        n = len(X)
+        order = (rng or np.random.default_rng()).permutation(n) if shuffle else None
+        X_buf = np.empty((min(batch_size, n),) + X.shape[1:], dtype=self.dtype)
+        # Class ids stay integers; regression targets use the model dtype.
+        y_dtype = np.intp if self.loss == "cross_entropy" else self.dtype
+        y_buf = np.empty((min(batch_size, n),) + y.shape[1:], dtype=y_dtype)
+        for start in range(0, n, batch_size):
+            stop = min(start + batch_size, n)
+            xb, yb = X_buf[:stop - start], y_buf[:stop - start]
+            if order is None:
+                xb[...] = X[start:stop]
+                yb[...] = y[start:stop]
+            else:
+                idx = np.sort(order[start:stop])  # sorted gathers read memory-mapped inputs sequentially
+                for src, dst in ((X, xb), (y, yb)):
+                    if src.dtype == dst.dtype:
+                        np.take(src, idx, axis=0, out=dst)
+                    else:
+                        dst[...] = src[idx]
+            yield xb, yb
+
+    def fit(self, X, y, epochs=1, batch_size=64, shuffle=True, seed=0, verbose=True):
+        '''Mini-batch training. X and y may be memory-mapped; batches are streamed through a reused buffer.
+        Returns the mean training loss of each epoch.'''
+        X = np.asarray(X)
+        y = np.asarray(y)
+        if self.loss == "cross_entropy":
+            y = y.reshape(-1)
+        elif y.ndim == 1:
+            y = y.reshape(-1, 1)
+        rng = np.random.default_rng(seed)
+        history = []
+        for epoch in range(epochs):
+            start = time.perf_counter()
+            total, seen = 0.0, 0
+            for xb, yb in self.iter_batches(X, y, batch_size, shuffle, rng):
+                total += self.train_step(xb, yb) * len(xb)
+                seen += len(xb)
+            history.append(total / seen)
+            if verbose:
+                elapsed = time.perf_counter() - start
+                print(f"Epoch {epoch+1}/{epochs} - Loss: {history[-1]:.6f} ({seen / elapsed:.0f} samples/s)")
+        return history
+
+    def _iter_chunks(self, X, batch_size):
+        # Arrays (including np.memmap) are sliced lazily; anything else is treated as an iterable of batches.
+        if hasattr(X, "shape"):
+            for start in range(0, len(X), batch_size):
+                yield X[start:start + batch_size]
+        else:
+            yield from X
+
+    def _predict_chunks(self, X, batch_size):
+        self._allocate(batch_size)
+        for chunk in self._iter_chunks(X, batch_size):
+            chunk = np.asarray(chunk, dtype=self.dtype)
+            for start in range(0, len(chunk), batch_size):
+                yield self._forward(chunk[start:start + batch_size])
+
+    def predict_proba(self, X, batch_size=1024):
+        '''Class probabilities (softmax outputs; raw outputs for the MSE head), computed batch_size rows at a time
+        so only one chunk of activations is alive at once. X can be an array, a memmap, or an iterable of batches.'''
+        return np.concatenate([out.copy() for out in self._predict_chunks(X, batch_size)])
+
+    def predict(self, X, batch_size=1024):
+        '''Predicted class ids, computed chunk by chunk without keeping the probabilities around.'''
+        return np.concatenate([out.argmax(axis=1) for out in self._predict_chunks(X, batch_size)])
+
+    def save(self, path, dtype=None, input_kind=None):
+        '''Write the model to a single file: a magic string, a JSON header (arch, dtype, activation, loss,
+        learning rate, input kind and array offsets) and the raw weight/bias arrays, each 64-byte aligned so that NN.load
+        can memory-map them in place. dtype=np.float16 halves the file size. input_kind overrides self.input_kind,
+        so a loader can refuse to feed the model the wrong kind of input.'''
+        if self.activation_name is None:
+            raise ValueError("Only models with a named activation can be saved; see register_activation.")
+        dtype = np.dtype(dtype or self.dtype)
+        arrays = self.weights + self.biases
+        entries, offset = [], 0
+        for array in arrays:
+            entries.append({"shape": list(array.shape), "offset": offset})
+            offset += -(-array.size * dtype.itemsize // ALIGNMENT) * ALIGNMENT
+        header = json.dumps({"arch": list(self.arch), "dtype": dtype.str, "activation": self.activation_name,
+                             "loss": self.loss, "learning_rate": self.lr, "input": input_kind or self.input_kind,
+                             "arrays": entries}).encode()
+        # Data starts at the first aligned offset after magic + header length + header.
+        data_start = -(-(len(MAGIC) + 4 + len(header)) // ALIGNMENT) * ALIGNMENT
+        with open(path, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<I", len(header)))
+            f.write(header)
+            for array, entry in zip(arrays, entries):
+                f.seek(data_start + entry["offset"])
+                f.write(np.ascontiguousarray(array, dtype=dtype).tobytes())
+            f.truncate(data_start + offset)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r", dtype=None):
+        '''Load a model written by save. With mmap_mode="r" the weights are read-only views of the file
+        (no copy, pages shared between processes scoring with the same model); use "c" to train on a
+        copy-on-write mapping or None to read into memory. dtype casts the weights (a copy), e.g. float16
+        storage to float32 compute.'''
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a saved NN model.")
+            (header_len,) = struct.unpack("<I", f.read(4))
+            header = json.loads(f.read(header_len))
+        data_start = -(-(len(MAGIC) + 4 + header_len) // ALIGNMENT) * ALIGNMENT
+        stored = np.dtype(header["dtype"])
+        if mmap_mode is None:
+            blob = np.fromfile(path, dtype=np.uint8, offset=data_start)
+        else:
+            blob = np.memmap(path, dtype=np.uint8, mode=mmap_mode, offset=data_start)
+        arrays = []
+        for entry in header["arrays"]:
+            count = int(np.prod(entry["shape"]))
+            array = blob[entry["offset"]:entry["offset"] + count * stored.itemsize].view(stored).reshape(entry["shape"])
+            arrays.append(array if dtype is None else array.astype(dtype))
+        half = len(header["arch"]) - 1
+        model = cls(header["arch"], learning_rate=header["learning_rate"], activation=header["activation"],
+                    dtype=stored if dtype is None else dtype, loss=header["loss"],
+                    weights=arrays[:half], biases=arrays[half:])
+        # Files written before the input kind was recorded were all trained on pixels.
+        model.input_kind = header.get("input", "pixels")
+        return model
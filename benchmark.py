@@ -0,0 +1,272 @@
+from PIL import Image
+import numpy as np
+import os, sys, json, time, shutil, argparse, platform, tempfile, subprocess, multiprocessing
+from datetime import datetime, timedelta
+
+import image_processing
+import metrics
+from NN import NN, tanh, tanh_grad
+
+"""
+Benchmarks for the capture-to-train pipeline.
+
+Usage:
+python benchmark.py black --folder ../colombia --limit 500
+python benchmark.py nn --samples 2048 --hidden 64
+python benchmark.py generate --out /tmp/corpus --countries 2 --images 200 --black-fraction 0.1
+python benchmark.py suite --out results/$(git rev-parse --short HEAD).json --images 200
+
+generate writes synthetic screenshot folders laid out like image_capture.py output, so the suite runs
+without real captures. suite generates a corpus (or uses --corpus), times every image_processing stage,
+dedup, dataset.main indexing, NN training steps and CustomCountriesDataset loading, and writes the
+timings plus machine details and a metrics snapshot as JSON. Compare two runs with
+python metrics.py compare or by diffing the "results" sections.
+"""
+
+def legacy_is_black(image_path, threshold=10):
+    # The original per-pixel implementation, kept as the baseline to compare against.
+    with Image.open(image_path) as img:
+        grayscale = img.convert('L')
+        black_pixels = sum(1 for pixel in grayscale.getdata() if pixel <= threshold)
+        total_pixels = grayscale.size[0] * grayscale.size[1]
+        ratio_black = black_pixels / total_pixels
+
+    return ratio_black > 0.95
+
+def time_call(func, items):
+    start = time.perf_counter()
+    results = [func(item) for item in items]
+    return time.perf_counter() - start, results
+
+def benchmark_black(folder, limit=None):
+    paths = sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.endswith((".jpg", ".png")))
+    paths = paths[:limit]
+    if not paths:
+        raise ValueError(f"No images found in {folder}")
+
+    legacy_time, legacy = time_call(legacy_is_black, paths)
+    full_time, full = time_call(lambda p: image_processing.is_black(p, draft_size=None), paths)
+    draft_time, draft = time_call(image_processing.is_black, paths)
+
+    print(f"{len(paths)} images from {folder}")
+    print(f"legacy generator:   {legacy_time:.3f} s ({len(paths) / legacy_time:.1f} pics/s)")
+    print(f"histogram:          {full_time:.3f} s ({len(paths) / full_time:.1f} pics/s, {legacy_time / full_time:.1f}x)")
+    print(f"histogram + draft:  {draft_time:.3f} s ({len(paths) / draft_time:.1f} pics/s, {legacy_time / draft_time:.1f}x)")
+    print(f"Disagreements with legacy: full={sum(a != b for a, b in zip(legacy, full))}, "
+          f"draft={sum(a != b for a, b in zip(legacy, draft))}")
+
+def benchmark_nn(samples=2048, features=224 * 224, hidden=64, outputs=5, batch_size=64, epochs=1):
+    # Flattened 224x224 inputs; random data is fine for throughput.
+    rng = np.random.default_rng(0)
+    X = rng.random((samples, features))
+    y = rng.random((samples, outputs))
+    arch = [features, hidden, outputs]
+    print(f"NN {arch}, {samples} samples, batch {batch_size}")
+
+    legacy = NN(arch, learning_rate=1e-4, activation=tanh, activation_grad=tanh_grad)
+    start = time.perf_counter()
+    for _ in range(epochs):
+        for i in range(0, samples, batch_size):
+            legacy.back_prop(X[i:i + batch_size], y[i:i + batch_size])
+    legacy_rate = samples * epochs / (time.perf_counter() - start)
+    print(f"back_prop loop (float64): {legacy_rate:.0f} samples/s")
+
+    for dtype in (np.float64, np.float32):
+        model = NN(arch, learning_rate=1e-4, activation=tanh, activation_grad=tanh_grad, dtype=dtype)
+        X_cast = X.astype(dtype)
+        start = time.perf_counter()
+        model.fit(X_cast, y, epochs=epochs, batch_size=batch_size, shuffle=False, verbose=False)
+        rate = samples * epochs / (time.perf_counter() - start)
+        print(f"fit ({np.dtype(dtype).name}): {rate:.0f} samples/s ({rate / legacy_rate:.1f}x)")
+        if dtype == np.float64:
+            drift = max(np.abs(a - b).max() for a, b in zip(model.weights, legacy.weights))
+            print(f"  max weight difference vs back_prop: {drift:.2e}")
+
+def synthetic_screenshot(rng, width, height, black=False):
+    """
+    A stand-in for a Street View screenshot: a smooth random colour field (sky/ground-like blobs) with
+    pixel noise, so it compresses about as badly as a photo. Black frames are near-black with a small
+    bright HUD-like box, like the frames remove_black_images is meant to catch.
+    """
+    if black:
+        pixels = rng.integers(0, 6, (height, width, 3), dtype=np.uint8)
+        pixels[height // 20:height // 10, width // 20:width // 5] = 230
+        return Image.fromarray(pixels)
+    coarse = rng.integers(0, 256, (9, 16, 3), dtype=np.uint8)
+    field = np.asarray(Image.fromarray(coarse).resize((width, height), Image.BICUBIC), dtype=np.int16)
+    field += rng.integers(-12, 13, (height, width, 1), dtype=np.int16)
+    return Image.fromarray(np.clip(field, 0, 255).astype(np.uint8))
+
+def generate_corpus(root, countries=2, images=100, resolution=(1920, 1080), black_fraction=0.1, fmt="png", seed=0):
+    """
+    Write root/<country>/<timestamp>_<country>.<fmt> screenshots, named like the capture writer names them.
+    Returns {country: number of images}.
+    """
+    rng = np.random.default_rng(seed)
+    width, height = resolution
+    start = datetime(2024, 1, 1)
+    counts = {}
+    for c in range(countries):
+        country = f"synthetic{c}"
+        folder = os.path.join(root, country)
+        os.makedirs(folder, exist_ok=True)
+        black = rng.random(images) < black_fraction
+        for i in range(images):
+            timestamp = (start + timedelta(seconds=c * images + i)).strftime("%m.%d.%Y_%H%M%S_%f")
+            image = synthetic_screenshot(rng, width, height, black[i])
+            image.save(os.path.join(folder, f"{timestamp}_{country}.{fmt}"), **({"quality": 90} if fmt == "jpg" else {}))
+        counts[country] = images
+    return counts
+
+def _stage(results, name, items, func, *args, **kwargs):
+    start = time.perf_counter()
+    value = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    results[name] = {"seconds": seconds, "items": items, "items_per_second": items / seconds if seconds else None}
+    print(f"{name:28s} {seconds:8.2f} s  {results[name]['items_per_second'] or 0:10.1f} items/s")
+    return value
+
+def _environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "time": datetime.now().isoformat(timespec="seconds"), "python": sys.version.split()[0],
+            "platform": platform.platform(), "processor": platform.processor(), "cpu_count": multiprocessing.cpu_count(),
+            "numpy": np.__version__, "pillow": Image.__version__}
+
+def benchmark_suite(output, corpus=None, countries=2, images=100, resolution=(1920, 1080), black_fraction=0.1,
+                    fmt="png", crop=224, nn_samples=1024, nn_hidden=64, loader_images=512, seed=0):
+    import dataset
+    from dedup import remove_duplicates
+
+    metrics.reset()
+    workdir = tempfile.mkdtemp(prefix="ggai_bench_")
+    results = {}
+    config = {"corpus": corpus, "countries": countries, "images": images, "resolution": list(resolution),
+              "black_fraction": black_fraction, "format": fmt, "crop": crop, "nn_samples": nn_samples,
+              "nn_hidden": nn_hidden, "loader_images": loader_images, "seed": seed}
+    try:
+        if corpus is None:
+            corpus = os.path.join(workdir, "corpus")
+            _stage(results, "generate", countries * images, generate_corpus, corpus, countries, images, resolution,
+                   black_fraction, fmt, seed)
+        names = sorted(name for name in os.listdir(corpus) if os.path.isdir(os.path.join(corpus, name)))
+        suffix = "." + fmt
+        total = sum(len([f for f in os.listdir(os.path.join(corpus, n)) if f.endswith(suffix)]) for n in names)
+
+        # Every variant works on its own copy, since the stages move and delete files.
+        def fresh(variant):
+            folder = os.path.join(workdir, variant)
+            shutil.copytree(corpus, folder)
+            return folder
+
+        # Three-pass flow: convert -> black filter -> center crop.
+        three_pass = fresh("three_pass")
+        for name in names:
+            folder = os.path.join(three_pass, name)
+            if fmt == "png":
+                _stage(results, f"convert[{name}]", total // len(names), image_processing.convert_png_to_jpg, folder)
+                _stage(results, f"move_pngs[{name}]", total // len(names), image_processing.move_pngs, folder)
+            _stage(results, f"remove_black[{name}]", total // len(names), image_processing.remove_black_images, folder)
+            _stage(results, f"resize[{name}]", total // len(names), image_processing.resize, folder,
+                   os.path.join(three_pass, f"{name}{crop}x{crop}"), crop, crop)
+            _stage(results, f"dedup[{name}]", total // len(names), remove_duplicates, os.path.join(three_pass, f"{name}{crop}x{crop}"))
+
+        # Tiling: several crops per screenshot in one decode.
+        for name in names:
+            folder = os.path.join(three_pass, name)
+            _stage(results, f"tile[{name}]", total // len(names), image_processing.resize, folder,
+                   os.path.join(three_pass, f"{name}_tiles"), crop, crop, tile=True, levels=(1, 2))
+
+        # Fused single-decode flow (PNG input only).
+        if fmt == "png":
+            fused = fresh("fused")
+            for name in names:
+                _stage(results, f"fused[{name}]", total // len(names), image_processing.process_folder,
+                       os.path.join(fused, name), os.path.join(fused, f"{name}{crop}x{crop}"), crop, crop)
+
+        crops = [f"{name}{crop}x{crop}" for name in names]
+        df = _stage(results, "dataset_index", total, dataset.main, crops, root=three_pass)
+        results["dataset_index"]["items"] = len(df)
+
+        # NN training steps on flattened crops (random data has the same cost as real pixels).
+        rng = np.random.default_rng(seed)
+        features = 3 * crop * crop
+        X = rng.random((nn_samples, features), dtype=np.float32)
+        labels = rng.integers(0, max(2, len(names)), nn_samples)
+        model = NN([features, nn_hidden, max(2, len(names))], learning_rate=1e-3, activation="relu",
+                   dtype=np.float32, loss="cross_entropy")
+        _stage(results, "nn_fit_epoch", nn_samples, model.fit, X, labels, epochs=1, batch_size=64, shuffle=False,
+               verbose=False)
+
+        # The notebook's loading path: read_image + tf per sample through a DataLoader.
+        try:
+            from torch.utils.data import DataLoader
+            from train import CustomCountriesDataset
+        except ImportError as e:
+            results["custom_dataset_load"] = {"skipped": str(e)}
+        else:
+            subset = df.iloc[:loader_images]
+            loader = DataLoader(CustomCountriesDataset(subset), batch_size=64)
+            _stage(results, "custom_dataset_load", len(subset), lambda: sum(len(y) for _, y in loader))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {"environment": _environment(),
+              "config": config,
+              "results": results,
+              "metrics": metrics.snapshot()}
+    directory = os.path.dirname(output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {output}")
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the capture-to-train pipeline.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    black = subparsers.add_parser("black", help="Compare black-frame detectors.")
+    black.add_argument("--folder", required=True)
+    black.add_argument("--limit", type=int, default=None)
+
+    nn = subparsers.add_parser("nn", help="Compare NN.back_prop with NN.fit.")
+    nn.add_argument("--samples", type=int, default=2048)
+    nn.add_argument("--features", type=int, default=224 * 224)
+    nn.add_argument("--hidden", type=int, default=64)
+    nn.add_argument("--outputs", type=int, default=5)
+    nn.add_argument("--batch-size", type=int, default=64)
+    nn.add_argument("--epochs", type=int, default=1)
+
+    generate = subparsers.add_parser("generate", help="Write a synthetic screenshot corpus.")
+    suite = subparsers.add_parser("suite", help="Time the whole pipeline and write the results as JSON.")
+    for sub in (generate, suite):
+        sub.add_argument("--countries", type=int, default=2)
+        sub.add_argument("--images", type=int, default=100, help="Screenshots per country.")
+        sub.add_argument("--resolution", type=int, nargs=2, default=[1920, 1080], metavar=("WIDTH", "HEIGHT"))
+        sub.add_argument("--black-fraction", type=float, default=0.1)
+        sub.add_argument("--format", choices=["png", "jpg"], default="png")
+        sub.add_argument("--seed", type=int, default=0)
+    generate.add_argument("--out", required=True)
+    suite.add_argument("--out", default="benchmark.json")
+    suite.add_argument("--corpus", default=None, help="Existing corpus to copy instead of generating one.")
+    suite.add_argument("--crop", type=int, default=224)
+    suite.add_argument("--nn-samples", type=int, default=1024)
+    suite.add_argument("--nn-hidden", type=int, default=64)
+    suite.add_argument("--loader-images", type=int, default=512)
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        print(generate_corpus(args.out, args.countries, args.images, tuple(args.resolution), args.black_fraction,
+                              args.format, args.seed))
+    elif args.command == "suite":
+        benchmark_suite(args.out, args.corpus, args.countries, args.images, tuple(args.resolution), args.black_fraction,
+                        args.format, args.crop, args.nn_samples, args.nn_hidden, args.loader_images, args.seed)
+    elif args.command == "black":
+        benchmark_black(args.folder, args.limit)
+    elif args.command == "nn":
+        benchmark_nn(args.samples, args.features, args.hidden, args.outputs, args.batch_size, args.epochs)
@@ -0,0 +1,183 @@
+import time, threading, traceback, os, argparse, getpass
+from tqdm import tqdm
+
+from image_capture import Browser, get_credentials
+from capture_writer import CaptureWriter
+
+"""
+Run several headless Browser workers in parallel.
+
+Each worker thread owns one Chrome instance and plays batches until the shared target is reached.
+A worker whose browser fails is torn down and restarted (with backoff) without affecting the others.
+All workers draw from one RateLimiter, so the total round rate stays bounded however many workers run.
+"""
+
+"""
+Raised from inside a game to unwind a worker once the target is reached.
+"""
+class CaptureStopped(Exception):
+    pass
+
+"""
+Token bucket shared between threads. acquire() blocks until a round may start.
+"""
+class RateLimiter():
+    def __init__(self, rounds_per_second, burst=1):
+        self.rate = rounds_per_second
+        self.capacity = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+"""
+Thread-safe image counter shared by all workers.
+"""
+class Progress():
+    def __init__(self, total):
+        self.total = total
+        self.count = 0
+        self.lock = threading.Lock()
+        self.bar = tqdm(total=total, desc="Image capture progress", unit="pics")
+
+    def update(self, n=1):
+        with self.lock:
+            self.count += n
+            self.bar.update(n)
+
+    def remaining(self):
+        with self.lock:
+            return self.total - self.count
+
+    def close(self):
+        self.bar.close()
+
+class CaptureOrchestrator():
+    def __init__(self, username, password, save_path, countries, num_workers=4, total_images=10000,
+                 batch_size=500, rounds_per_second=None, max_restarts=10, headless=True,
+                 capture_mode="png", crop_size=(224, 224), keep_png=False, writer_workers=4, **browser_kwargs):
+        self.username = username
+        self.password = password
+        self.save_path = save_path
+        self.countries = countries
+        self.num_workers = num_workers
+        # Games are 5 rounds long; start_game plays whole games only.
+        self.batch_size = max(5, batch_size - batch_size % 5)
+        self.max_restarts = max_restarts
+        self.headless = headless
+        self.browser_kwargs = browser_kwargs
+        self.rate_limiter = RateLimiter(rounds_per_second)
+        self.progress = Progress(total_images)
+        self.stop_event = threading.Event()
+        # Total restarts per worker, for the summary. Giving up is decided on failures in a row.
+        self.restarts = [0] * num_workers
+        # One writer pool for all browsers, so the queue depth reflects the whole capture.
+        self.writer = CaptureWriter(save_path, mode=capture_mode, crop_size=crop_size, keep_png=keep_png,
+                                    num_workers=writer_workers, max_queue=16 * num_workers)
+
+    def make_browser(self):
+        return Browser(self.username, self.password, self.save_path, headless=self.headless,
+                       before_round=self.before_round, after_round=self.after_round, writer=self.writer,
+                       **self.browser_kwargs)
+
+    def before_round(self):
+        if self.stop_event.is_set():
+            raise CaptureStopped()
+        self.rate_limiter.acquire()
+
+    def after_round(self):
+        self.progress.update(1)
+        if self.progress.remaining() <= 0:
+            self.stop_event.set()
+
+    def worker(self, worker_id):
+        # Spread workers over the requested countries (or sessions of the same country).
+        country = self.countries[worker_id % len(self.countries)]
+        browser = None
+        logged_in = False
+        backoff = 1
+        failures = 0
+        while not self.stop_event.is_set():
+            try:
+                if browser is None:
+                    browser = self.make_browser()
+                    logged_in = False
+                remaining = self.progress.remaining()
+                if remaining <= 0:
+                    break
+                # Only a fresh browser logs in; later batches go straight to a new game.
+                browser.start_game(country=country, num_images=min(self.batch_size, remaining + 4), show_progress=False,
+                                   login=not logged_in)
+                logged_in = True
+                backoff = 1
+                failures = 0
+            except CaptureStopped:
+                break
+            except Exception:
+                self.restarts[worker_id] += 1
+                failures += 1
+                print(f"Worker {worker_id} ({country}) failed, {failures}/{self.max_restarts} in a row:")
+                traceback.print_exc()
+                if browser is not None:
+                    try:
+                        browser.quit()
+                    except Exception:
+                        pass
+                    browser = None
+                if failures >= self.max_restarts:
+                    print(f"Worker {worker_id} gave up.")
+                    break
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+        if browser is not None:
+            browser.quit()
+
+    def run(self):
+        threads = [threading.Thread(target=self.worker, args=(i,), name=f"capture-{i}") for i in range(self.num_workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        except KeyboardInterrupt:
+            self.stop_event.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            self.progress.close()
+            self.writer.close()
+            self.writer.report()
+        print(f"Captured {self.progress.count} images with {self.num_workers} workers, {sum(self.restarts)} restarts.")
+        return self.progress.count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Capture Street View images with several browsers at once.")
+    parser.add_argument("countries", nargs="+")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--total", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=None, help="Global cap on rounds per second.")
+    parser.add_argument("--game-link", default="https://www.geoguessr.com")
+    parser.add_argument("--show-browsers", action="store_true")
+    parser.add_argument("--capture-mode", choices=["png", "memory"], default="png")
+    args = parser.parse_args()
+
+    username, password = get_credentials(admin_name=getpass.getuser(), admin=True)
+    save_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    CaptureOrchestrator(username, password, save_path, args.countries, num_workers=args.workers,
+                        total_images=args.total, batch_size=args.batch_size, rounds_per_second=args.rate,
+                        headless=not args.show_browsers, capture_mode=args.capture_mode,
+                        game_link=args.game_link).run()
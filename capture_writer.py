@@ -0,0 +1,209 @@
+import os, io, time, queue, threading
+import numpy as np
+from datetime import datetime
+
+from image_processing import crop_screenshot
+import metrics
+
+"""
+Background writer for captured screenshots.
+
+The browser loop only calls put() with the raw PNG bytes and a little metadata; a pool of writer
+threads builds the paths, creates directories, encodes (in "memory" mode) and writes the files.
+The queue is bounded: when the writers fall behind, put() blocks, which slows the browser down
+instead of letting screenshots pile up in RAM. A screenshot that cannot be encoded or written is
+logged, counted in stats()["failed"] and dropped; it never stops the writer. stats() tells whether capture is I/O-bound:
+a queue that sits near max_queue, or a large blocked_seconds, means the disk is the bottleneck.
+
+Modes (see Browser):
+"png"    - write the PNG to save_path/<country>/<name>.png
+"memory" - black-check and crop to crop_size, write save_path/<country><w>x<h>/<name>.jpg,
+           and the PNG to save_path/<country>_pngs/ if keep_png is set.
+"""
+class CaptureWriter():
+    def __init__(self, save_path, mode="png", crop_size=(224, 224), keep_png=False,
+                 num_workers=2, max_queue=64, batch_size=16, fsync=True):
+        if mode not in ("png", "memory"):
+            raise ValueError(f"Unknown capture_mode: {mode}")
+        self.save_path = save_path
+        self.mode = mode
+        self.crop_size = crop_size
+        self.keep_png = keep_png
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.known_dirs = set()
+        self.lock = threading.Lock()
+        # Stats
+        self.enqueued = 0
+        self.written = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes_written = 0
+        self.max_depth = 0
+        self.blocked_seconds = 0.0
+        self.latencies = []
+        self.threads = [threading.Thread(target=self._run, name=f"capture-writer-{i}", daemon=True)
+                        for i in range(num_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    """
+    Enqueue one screenshot. Blocks while the queue is full (backpressure).
+    """
+    def put(self, png, country, timestamp=None):
+        item = (png, country, time.time() if timestamp is None else timestamp, time.monotonic())
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            start = time.monotonic()
+            self.queue.put(item)
+            with self.lock:
+                self.blocked_seconds += time.monotonic() - start
+        with self.lock:
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            batch = [item]
+            # Drain whatever else is already waiting so directory setup and dir fsyncs are shared by the batch.
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    # Put the sentinel back for this thread's next loop.
+                    self.queue.task_done()
+                    self.queue.put(None)
+                    break
+                batch.append(item)
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                # Per-item failures are handled in _write_batch; this is e.g. a directory that cannot be created.
+                self._fail(len(batch), e)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _fail(self, count, error):
+        print(f"Capture writer: dropped {count} screenshot(s): {type(error).__name__}: {error}")
+        metrics.count("capture.write_errors", count)
+        with self.lock:
+            self.failed += count
+
+    def _paths(self, country, timestamp):
+        name = f"{datetime.fromtimestamp(timestamp).strftime('%m.%d.%Y_%H%M%S_%f')}_{country}"
+        if self.mode == "png":
+            return os.path.join(self.save_path, country, f"{name}.png"), None
+        width, height = self.crop_size
+        jpg_path = os.path.join(self.save_path, f"{country}{width}x{height}", f"{name}.jpg")
+        png_path = os.path.join(self.save_path, f"{country}_pngs", f"{name}.png") if self.keep_png else None
+        return png_path, jpg_path
+
+    def _write_batch(self, batch):
+        files = []
+        for png, country, timestamp, enqueued_at in batch:
+            png_path, jpg_path = self._paths(country, timestamp)
+            if png_path is not None:
+                files.append((png_path, png))
+            if jpg_path is not None:
+                try:
+                    with metrics.timer("capture.encode"):
+                        cropped_image = crop_screenshot(png, *self.crop_size)
+                        if cropped_image is not None:
+                            buffer = io.BytesIO()
+                            cropped_image.save(buffer, format="JPEG")
+                except Exception as e:
+                    self._fail(1, e)
+                    continue
+                if cropped_image is None:
+                    metrics.count("capture.black_skipped")
+                    with self.lock:
+                        self.skipped += 1
+                else:
+                    files.append((jpg_path, buffer.getvalue()))
+
+        # One makedirs per new directory, not one existence check per file.
+        dirs = {os.path.dirname(path) for path, _ in files}
+        with self.lock:
+            new_dirs = dirs - self.known_dirs
+            self.known_dirs |= new_dirs
+        for directory in new_dirs:
+            os.makedirs(directory, exist_ok=True)
+
+        written = []
+        with metrics.timer("capture.write_batch"):
+            for path, data in files:
+                try:
+                    self._atomic_write(path, data)
+                except OSError as e:
+                    self._fail(1, e)
+                else:
+                    written.append((path, data))
+        files = written
+        if self.fsync and hasattr(os, "O_DIRECTORY"):
+            # Make the renames themselves durable, once per directory per batch.
+            for directory in dirs:
+                fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+        now = time.monotonic()
+        with self.lock:
+            self.written += len(files)
+            self.bytes_written += sum(len(data) for _, data in files)
+            self.latencies.extend(now - item[3] for item in batch)
+        metrics.add_bytes("capture.written", sum(len(data) for _, data in files))
+        metrics.count("capture.files_written", len(files))
+        for item in batch:
+            metrics.observe("capture.queue_to_disk", now - item[3])
+
+    def _atomic_write(self, path, data):
+        # Write to a temporary name and rename, so a crash never leaves a truncated image behind.
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def stats(self):
+        with self.lock:
+            latencies = np.asarray(self.latencies) if self.latencies else np.zeros(1)
+            return {
+                "queue_depth": self.queue.qsize(),
+                "max_queue_depth": self.max_depth,
+                "enqueued": self.enqueued,
+                "files_written": self.written,
+                "black_skipped": self.skipped,
+                "failed": self.failed,
+                "bytes_written": self.bytes_written,
+                "blocked_seconds": self.blocked_seconds,
+                "latency_p50": float(np.percentile(latencies, 50)),
+                "latency_p99": float(np.percentile(latencies, 99)),
+            }
+
+    def report(self):
+        s = self.stats()
+        print(f"Writer: {s['files_written']} files, {s['failed']} failed, {s['bytes_written'] / 1024**2:.1f} MB, "
+              f"queue {s['queue_depth']} (max {s['max_queue_depth']}), blocked {s['blocked_seconds']:.1f} s, "
+              f"latency p50 {s['latency_p50'] * 1000:.0f} ms p99 {s['latency_p99'] * 1000:.0f} ms")
+
+    """
+    Flush everything still queued and stop the writer threads.
+    """
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
@@ -1,36 +1,238 @@
+import numpy as np
 import pandas as pd
-import os, sys
+import os, sys, json, time, queue, threading
+from concurrent.futures import ThreadPoolExecutor
 
-def main(countries_list):
-    df = pd.DataFrame()
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import metrics
+
+DATA_ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+SCHEMA = pa.schema([("images", pa.string()), ("class", pa.int64())])
+
+"""
+Class ids are read from (and appended to) a saved JSON mapping, so a country keeps the same id
+no matter which order the filesystem lists folders in or which subset of countries is indexed.
+"""
+def load_class_mapping(mapping_path, countries_list):
+    mapping = {}
+    if mapping_path is not None and os.path.exists(mapping_path):
+        with open(mapping_path) as f:
+            mapping = json.load(f)
+    changed = False
+    for country in countries_list:
+        if country not in mapping:
+            mapping[country] = max(mapping.values(), default=-1) + 1
+            changed = True
+    if changed and mapping_path is not None:
+        with open(mapping_path, "w") as f:
+            json.dump(mapping, f, indent=2)
+    return mapping
+
+"""
+Locate each requested country folder anywhere below root, without descending into the country folders themselves.
+"""
+def find_country_folders(root, countries_list):
+    wanted = set(countries_list)
+    found = {}
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if not entry.is_dir():
+                    continue
+                if entry.name in wanted:
+                    found.setdefault(entry.name, entry.path)
+                else:
+                    stack.append(entry.path)
+    return found
+
+"""
+Yield the .jpg paths below folder in batches. Entries are visited in name order (subfolders
+depth-first), so the same tree always gives the same sequence whatever order scandir lists it in.
+"""
+def scan_country(folder, batch_size=4096):
+    batch = []
+    stack = [folder]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        subfolders = []
+        for entry in entries:
+            if entry.is_dir():
+                subfolders.append(entry.path)
+            elif entry.name.endswith(".jpg"):
+                batch.append(entry.path)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        stack.extend(reversed(subfolders))
+    if batch:
+        yield batch
+
+"""
+Scan the country folders in parallel and yield (paths, class_id) batches, country by country in
+countries_list order. Each scan runs ahead into its own small queue, so only a bounded number of
+batches is held in memory at once and the output order does not depend on thread timing.
+"""
+def iter_index(countries_list, root=DATA_ROOT, mapping_path=None, batch_size=4096, max_workers=None):
+    mapping = load_class_mapping(mapping_path, countries_list)
+    folders = find_country_folders(root, countries_list)
+    for country in countries_list:
+        if country not in folders:
+            print(f"Warning: no folder found for {country} under {root}")
+
+    order = [country for country in dict.fromkeys(countries_list) if country in folders]
+    batches = {country: queue.Queue(maxsize=max(1, 16 // max(1, len(order)))) for country in order}
+    done = object()
+    stop = threading.Event()
+
+    def put(country, item):
+        # Block while the consumer is behind, but give up if it has gone away.
+        while not stop.is_set():
+            try:
+                batches[country].put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def scan(country):
+        try:
+            for paths in scan_country(folders[country], batch_size):
+                if not put(country, (paths, mapping[country])):
+                    return
+        finally:
+            put(country, done)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers or max(1, len(order)))
+    futures = [executor.submit(scan, country) for country in order]
+    try:
+        for country in order:
+            while True:
+                item = batches[country].get()
+                if item is done:
+                    break
+                yield item
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
+        for future in futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+"""
+Stream the index into a Parquet file with columns images (str) and class (int64). Rows follow
+iter_index order (countries_list order, then name order within each folder), so re-indexing the
+same tree gives the same file, and with it the same seeded splits and tensor cache.
+Returns the number of rows written.
+"""
+def write_index(countries_list, output_path, root=DATA_ROOT, mapping_path=None, batch_size=4096):
+    rows = 0
+    with metrics.timer("dataset.write_index"), pq.ParquetWriter(output_path, SCHEMA) as writer:
+        for paths, class_id in iter_index(countries_list, root, mapping_path, batch_size):
+            table = pa.table({"images": paths, "class": [class_id] * len(paths)}, schema=SCHEMA)
+            writer.write_table(table)
+            rows += len(paths)
+    metrics.count("dataset.images", rows)
+    metrics.add_bytes("dataset.index_written", os.path.getsize(output_path))
+    return rows
+
+"""
+In-memory index as a DataFrame sorted by images, for notebooks and small datasets. The whole index
+is held in Python lists and a DataFrame; use write_index to stream a large one to disk instead.
+"""
+def main(countries_list, root=DATA_ROOT, mapping_path=None):
     names = []
     cl = []
-    i = 0
-    for root, dirs, files in os.walk(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data"), topdown=False):
-        for folder in dirs:
-            if folder in countries_list:
-                for dirpath, _, filenames in os.walk(os.path.join(root, folder)):
-                    img_paths = [os.path.join(root, folder, name) for name in filenames if name.endswith(".jpg")] # python list
-                    names += img_paths
-                    cl += [i] * len(img_paths)
-                i += 1
-    
-    df["images"] = names
-    df["class"] = cl
+    with metrics.timer("dataset.index"):
+        for paths, class_id in iter_index(countries_list, root, mapping_path):
+            names += paths
+            cl += [class_id] * len(paths)
+    metrics.count("dataset.images", len(names))
+
+    # Sorted by path (not iter_index's per-country order), as the notebook has always read it.
+    df = pd.DataFrame({"images": names, "class": cl}).sort_values("images", ignore_index=True)
     print(df)
     return df
+
+"""
+Add a group column for leak-free splits. Tiles cut from the same screenshot (image_processing.parent_id)
+share a group, and so do near-duplicates (dedup.duplicate_groups, skipped with dedup=False); both
+relations are merged transitively. Group ids are unique across folders.
+"""
+def add_duplicate_groups(df, max_distance=4, dedup=True):
+    from image_processing import parent_id
+    parents = {}
+
+    def find(node):
+        parents.setdefault(node, node)
+        while parents[node] != node:
+            parents[node] = parents[parents[node]]
+            node = parents[node]
+        return node
+
+    def parent(path):
+        return os.path.join(os.path.dirname(path), parent_id(path))
+
+    if dedup:
+        from dedup import duplicate_groups
+        for folder in df["images"].map(os.path.dirname).unique():
+            for name, group in duplicate_groups(folder, max_distance).items():
+                parents[find(parent(os.path.join(folder, name)))] = find(parent(os.path.join(folder, group)))
+    df = df.copy()
+    df["group"] = [find(parent(path)) for path in df["images"]]
+    return df
+
+"""
+Split row positions of df into (train, test) so that no group is on both sides.
+Like train_test_split, test_size is a fraction of rows; whole groups are moved to the test side
+in shuffled order, skipping any that would overshoot, until it is reached.
+"""
+def group_split(df, test_size=0.2, seed=None, group_column="group"):
+    codes, uniques = pd.factorize(df[group_column])
+    sizes = np.bincount(codes, minlength=len(uniques))
+    order = np.random.default_rng(seed).permutation(len(uniques))
+    in_test = np.zeros(len(uniques), dtype=bool)
+    target, filled = round(test_size * len(df)), 0
+    for group in order:
+        # A large group that does not fit goes to train; smaller ones after it can still fill the gap.
+        if filled + sizes[group] <= target:
+            in_test[group] = True
+            filled += sizes[group]
+            if filled == target:
+                break
+    test_rows = in_test[codes]
+    return np.flatnonzero(~test_rows), np.flatnonzero(test_rows)
+
 if __name__ == "__main__":
     dim = 224
     countries = ["taiwan", "andorra"] # taiwan may not be a "country"!!!
     for i in range(len(countries)):
         countries[i] = f"{countries[i]}{dim}x{dim}"
-    
-    df = main(countries_list=countries)
-    
-    
+    # Also write the CSV the notebook reads.
+    write_csv = True
+    # Add a group column of near-duplicates so train.make_loaders keeps them on one side of the split.
+    dedup_groups = True
+
     current_directory = os.getcwd()
     parent_directory = os.path.dirname(current_directory)
-    file_path = os.path.join(parent_directory, f"output_{dim}.csv")
-    # Save the DataFrame to a CSV file
-    df.to_csv(file_path, index=False)  # Set index=False to exclude the index from the CSV file
+    mapping_path = os.path.join(parent_directory, f"classes_{dim}.json")
+    parquet_path = os.path.join(parent_directory, f"output_{dim}.parquet")
+    # Scan timings, image counts and bytes written are saved here (JSON + .prom) at the end of the run.
+    metrics_path = os.path.join(parent_directory, "metrics", f"indexing_{time.strftime('%m.%d.%Y_%H%M%S')}.json")
+
+    rows = write_index(countries, parquet_path, mapping_path=mapping_path)
+    print(f"Indexed {rows} images into {parquet_path}")
+
+    if write_csv:
+        file_path = os.path.join(parent_directory, f"output_{dim}.csv")
+        # Save the DataFrame to a CSV file
+        df = pd.read_parquet(parquet_path)
+        if dedup_groups:
+            df = add_duplicate_groups(df)
+        df.to_csv(file_path, index=False)  # Set index=False to exclude the index from the CSV file
 
+    print(metrics.summary())
+    metrics.write_report(metrics_path)
@@ -0,0 +1,173 @@
+from PIL import Image
+from tqdm import tqdm
+import numpy as np
+import os, json, multiprocessing
+
+import metrics
+from concurrent.futures import ProcessPoolExecutor
+
+"""
+Perceptual-hash deduplication of captures.
+
+Overnight runs replay the same map and often land on the same panorama. Each image gets a 64-bit
+dHash (difference hash on a 9x8 grayscale thumbnail), which changes little under re-encoding, small
+shifts or HUD differences. Hashes are kept in an on-disk index (append-only JSONL, like
+manifest.Manifest) and in a BK-tree for Hamming-distance queries, so a new batch is only compared
+against what is already indexed instead of re-hashing the whole folder.
+
+Images within max_distance bits of an indexed image are near-duplicates. remove_duplicates deletes
+them (keeping the first one seen); duplicate_groups assigns every image a group id so train/test
+splits can keep a group on one side (see dataset.group_split).
+"""
+
+def dhash(image):
+    # Draft decode is enough for a 9x8 thumbnail (JPEG only; a no-op for PNG).
+    image.draft('L', (128, 128))
+    pixels = np.asarray(image.convert('L').resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+def hash_file(path):
+    with Image.open(path) as image:
+        return path, dhash(image)
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+"""
+BK-tree over Hamming distance: query(h, d) visits only subtrees whose edge distance is within d of
+dist(h, node), which prunes most of the index for small d.
+"""
+class BKTree():
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, item_hash, item):
+        node = self.root
+        if node is None:
+            self.root = [item_hash, [item], {}]
+            self.size += 1
+            return
+        while True:
+            distance = hamming(item_hash, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [item_hash, [item], {}]
+                self.size += 1
+                return
+            node = child
+
+    def query(self, item_hash, max_distance):
+        # Returns [(distance, item), ...] for every indexed item within max_distance.
+        results = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(item_hash, node[0])
+            if distance <= max_distance:
+                results.extend((distance, item) for item in node[1])
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        return results
+
+class DedupIndex():
+    def __init__(self, path, max_distance=4):
+        self.path = path
+        self.max_distance = max_distance
+        self.tree = BKTree()
+        self.hashes = {}
+        self.groups = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._insert(record["name"], record["hash"], record["group"])
+
+    @classmethod
+    def for_folder(cls, folder_path, max_distance=4):
+        return cls(os.path.join(folder_path, ".dedup.jsonl"), max_distance)
+
+    def _insert(self, name, image_hash, group):
+        self.hashes[name] = image_hash
+        self.groups[name] = group
+        self.tree.add(image_hash, name)
+
+    """
+    Look up image_hash; returns (group id, name of the closest indexed image or None).
+    """
+    def match(self, image_hash):
+        matches = self.tree.query(image_hash, self.max_distance)
+        if not matches:
+            return None, None
+        distance, name = min(matches)
+        return self.groups[name], name
+
+    """
+    Add new (name, hash) pairs to the index. Each joins the group of its nearest indexed neighbour
+    or starts a new group. Returns {name: duplicate_of or None}.
+    """
+    def add(self, hashed):
+        results, lines = {}, []
+        for name, image_hash in hashed:
+            if name in self.hashes:
+                continue
+            group, duplicate_of = self.match(image_hash)
+            if group is None:
+                group = name
+            self._insert(name, image_hash, group)
+            results[name] = duplicate_of
+            lines.append(json.dumps({"name": name, "hash": image_hash, "group": group}) + "\n")
+        if lines:
+            with open(self.path, "a") as f:
+                f.writelines(lines)
+        return results
+
+def _hash_new(folder_path, index, names):
+    paths = [os.path.join(folder_path, name) for name in sorted(names) if name not in index.hashes]
+    workers = multiprocessing.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        hashed = list(tqdm(executor.map(hash_file, paths, chunksize=max(1, len(paths) // (workers * 8))),
+                           total=len(paths), desc="Hashing images", unit="pics"))
+    return [(os.path.basename(path), image_hash) for path, image_hash in hashed]
+
+"""
+Hash the images in folder_path that are not indexed yet and delete every image that is a near-duplicate
+of an earlier one (indexed in a previous batch or earlier in this one). The first image of each group is
+kept; if it is no longer on disk (the index outlives deletions), the first surviving name in sorted order
+is kept instead, so every group keeps one copy. Returns the removed names.
+"""
+def remove_duplicates(folder_path, max_distance=4, suffix=".jpg"):
+    index = DedupIndex.for_folder(folder_path, max_distance)
+    names = {name for name in os.listdir(folder_path) if name.endswith(suffix)}
+    with metrics.timer("process.dedup_stage"):
+        new = index.add(_hash_new(folder_path, index, names))
+    keep = {}
+    for name in sorted(names):
+        group = index.groups[name]
+        keep.setdefault(group, group if group in names else name)
+    # Also catches duplicates indexed by duplicate_groups, which never deletes anything.
+    removed = sorted(name for name in names if keep[index.groups[name]] != name)
+    for name in removed:
+        os.remove(os.path.join(folder_path, name))
+    metrics.count("process.dedup_hashed", len(new))
+    metrics.count("process.dedup_removed", len(removed))
+    print(f"Removed {len(removed)} near-duplicate images ({len(new)} new, {len(index.hashes)} indexed).")
+    return removed
+
+"""
+Index folder_path without deleting anything and return {name: group id}. Images in the same group are
+near-duplicates of each other and should not be split across train and test.
+"""
+def duplicate_groups(folder_path, max_distance=4, suffix=".jpg"):
+    index = DedupIndex.for_folder(folder_path, max_distance)
+    names = {name for name in os.listdir(folder_path) if name.endswith(suffix)}
+    index.add(_hash_new(folder_path, index, names))
+    return {name: index.groups[name] for name in names}
@@ -0,0 +1,271 @@
+import numpy as np
+import pandas as pd
+import os, json, time, hashlib, argparse, multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+import torch
+import torch.nn as nn
+from torch import optim
+from torch.utils.data import DataLoader, TensorDataset
+
+import metrics
+from train import CNN, CustomCountriesDataset, tf, split_indices
+from NN import NN
+
+"""
+Frozen-backbone embedding cache.
+
+The convolutional part of a model runs once per image; its pooled output is stored as float16 in
+memory-mapped chunks, so heads (the notebook's fcl, or NN.NN) train on features in minutes instead of
+re-running the CNN on every JPEG every epoch. Entries are keyed by image path and content hash: an
+update only embeds images that are new or whose file changed, and identical files share one row.
+
+python embeddings.py extract --csv ../output_224.csv --store ../embeddings_cnn --backbone cnn --weights model.pt
+python embeddings.py extract --csv ../output_224.csv --store ../embeddings_r18 --backbone resnet18
+python embeddings.py train --csv ../output_224.csv --store ../embeddings_cnn --head fcl --epochs 20
+
+store_dir/
+├── index.json           (backbone, dim, chunks, path -> [chunk, row, hash, size, mtime_ns])
+├── embeddings_00000.npy (float16, (count, dim))
+└── ...
+"""
+
+"""
+Frozen feature extractor returning (N, dim) pooled embeddings.
+
+backbone "cnn" is CNN.convolutions (weights from train.py --save, or random) followed by adaptive
+average pooling to pool x pool; pool=14 keeps the full 512*14*14 map the notebook's fcl was built for.
+Any other name is a torchvision model with pretrained weights and its classifier removed.
+"""
+class Backbone(nn.Module):
+    def __init__(self, name="cnn", weights=None, pool=1):
+        super().__init__()
+        self.name = name
+        if name == "cnn":
+            model = CNN(num_classes=1)
+            if weights is not None:
+                state = torch.load(weights, map_location="cpu")
+                model = CNN(num_classes=state["fcl.2.weight"].shape[0])
+                model.load_state_dict(state)
+            # Drop the Flatten so the map can be pooled first.
+            self.features = nn.Sequential(*list(model.convolutions)[:-1], nn.AdaptiveAvgPool2d(pool), nn.Flatten())
+            self.dim = 512 * pool * pool
+            self.description = {"backbone": name, "weights": _file_hash(weights) if weights else None, "pool": pool}
+        else:
+            import torchvision
+            model = getattr(torchvision.models, name)(weights="DEFAULT")
+            if not hasattr(model, "fc"):
+                raise ValueError(f"Unsupported torchvision backbone {name}: expected a model with an fc classifier.")
+            self.dim = model.fc.in_features
+            model.fc = nn.Identity()
+            self.features = model
+            self.description = {"backbone": name, "weights": "DEFAULT", "pool": None}
+        self.eval()
+        for parameter in self.parameters():
+            parameter.requires_grad_(False)
+
+    def forward(self, x):
+        return self.features(x)
+
+def _file_hash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _stat_and_hash(args):
+    path, known = args
+    stat = os.stat(path)
+    # Only re-read files whose size or mtime changed since they were hashed.
+    if known is not None and known[3] == stat.st_size and known[4] == stat.st_mtime_ns:
+        return path, known[2], stat.st_size, stat.st_mtime_ns
+    return path, _file_hash(path), stat.st_size, stat.st_mtime_ns
+
+class EmbeddingStore():
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.index_path = os.path.join(store_dir, "index.json")
+        self.index = None
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        self._chunks = None
+
+    def _check(self, backbone):
+        if self.index is None:
+            os.makedirs(self.store_dir, exist_ok=True)
+            self.index = {"description": backbone.description, "dim": backbone.dim, "chunks": [], "entries": {}}
+        elif self.index["description"] != backbone.description:
+            raise ValueError(f"{self.store_dir} holds embeddings of {self.index['description']}, "
+                             f"not {backbone.description}; use another store directory.")
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def update(self, paths, backbone, batch_size=64, num_workers=0):
+        """
+        Embed the paths that are new or changed since the last update into a new chunk.
+        Returns the number of distinct images embedded: paths sharing content (duplicates, renames,
+        unchanged files) reuse one row, so this is not the number of paths that were new or changed.
+        """
+        self._check(backbone)
+        entries = self.index["entries"]
+        with ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
+            stats = list(tqdm(executor.map(_stat_and_hash, [(path, entries.get(path)) for path in paths]),
+                              total=len(paths), desc="Hashing images", unit="pics"))
+        by_hash = {entry[2]: entry for entry in entries.values()}
+        # todo: paths needing a row in the new chunk; unique: one path per distinct content, in row order.
+        todo, unique, rows = [], [], {}
+        for path, content_hash, size, mtime_ns in stats:
+            known = by_hash.get(content_hash)
+            if known is not None:
+                # Same content already embedded (unchanged, renamed or duplicated): reuse its row.
+                entries[path] = [known[0], known[1], content_hash, size, mtime_ns]
+                continue
+            if content_hash not in rows:
+                rows[content_hash] = len(unique)
+                unique.append(path)
+            todo.append((path, content_hash, size, mtime_ns))
+        if not unique:
+            self._save_index()
+            return 0
+
+        chunk_id = len(self.index["chunks"])
+        name = f"embeddings_{chunk_id:05d}.npy"
+        store = np.lib.format.open_memmap(os.path.join(self.store_dir, name), mode="w+", dtype=np.float16,
+                                          shape=(len(unique), backbone.dim))
+        frame = pd.DataFrame({"images": unique, "class": 0})
+        loader = DataLoader(CustomCountriesDataset(frame, transform=tf), batch_size=batch_size, num_workers=num_workers)
+        row = 0
+        with torch.no_grad(), metrics.timer("embeddings.extract"):
+            for X_batch, _ in tqdm(loader, desc="Embedding", unit="batch"):
+                start = time.perf_counter()
+                features = backbone(X_batch)
+                metrics.observe("embeddings.batch", time.perf_counter() - start)
+                store[row:row + len(features)] = features.numpy().astype(np.float16)
+                row += len(features)
+        store.flush()
+        del store
+        metrics.count("embeddings.computed", len(unique))
+
+        for path, content_hash, size, mtime_ns in todo:
+            entries[path] = [chunk_id, rows[content_hash], content_hash, size, mtime_ns]
+        self.index["chunks"].append({"file": name, "count": len(unique)})
+        # Written last: an interrupted update leaves an orphan chunk file, never a dangling index entry.
+        self._save_index()
+        self._chunks = None
+        return len(unique)
+
+    def lookup(self, paths):
+        """
+        (len(paths), dim) float16 array of the stored embeddings. Every path must have been updated.
+        """
+        if self._chunks is None:
+            self._chunks = [np.load(os.path.join(self.store_dir, chunk["file"]), mmap_mode="r")
+                            for chunk in self.index["chunks"]]
+        entries = self.index["entries"]
+        missing = [path for path in paths if path not in entries]
+        if missing:
+            raise KeyError(f"{len(missing)} images have no embedding yet (e.g. {missing[0]}); run update first.")
+        locations = np.array([entries[path][:2] for path in paths], dtype=np.int64).reshape(-1, 2)
+        out = np.empty((len(paths), self.index["dim"]), dtype=np.float16)
+        # One fancy-indexed gather per chunk instead of one row copy per image.
+        for chunk in np.unique(locations[:, 0]):
+            mask = locations[:, 0] == chunk
+            out[mask] = self._chunks[chunk][locations[mask, 1]]
+        return out
+
+"""
+A head shaped like CNN.fcl (Linear -> ReLU -> Linear -> Softmax), taking in_features embeddings.
+"""
+def fcl_head(in_features, num_classes, hidden=120):
+    return nn.Sequential(
+        nn.Linear(in_features, hidden),
+        nn.ReLU(inplace=True),
+        nn.Linear(hidden, num_classes),
+        nn.Softmax(dim=1)
+    )
+
+def train_fcl(X_train, y_train, X_test, y_test, num_classes, epochs=20, lr=1e-3, weight_decay=0.001, batch_size=256):
+    head = fcl_head(X_train.shape[1], num_classes)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.AdamW(head.parameters(), lr=lr, weight_decay=weight_decay)
+    train_dl = DataLoader(TensorDataset(torch.from_numpy(X_train.astype(np.float32)), torch.from_numpy(y_train)),
+                          batch_size=batch_size, shuffle=True)
+    X_test = torch.from_numpy(X_test.astype(np.float32))
+    for epoch in range(epochs):
+        head.train()
+        running_loss = 0.0
+        for X_batch, y_batch in train_dl:
+            loss = criterion(head(X_batch), y_batch)
+            optimizer.zero_grad(set_to_none=True)
+            loss.backward()
+            optimizer.step()
+            running_loss += loss.item() * len(y_batch)
+        head.eval()
+        with torch.no_grad():
+            val_acc = (head(X_test).argmax(dim=1).numpy() == y_test).mean()
+        print(f"Epoch {epoch+1}/{epochs} - Train loss: {running_loss / len(y_train):.4f} - Validation acc: {val_acc:.4f}")
+    return head, float(val_acc)
+
+def train_nn(X_train, y_train, X_test, y_test, num_classes, epochs=20, lr=0.01, batch_size=256, hidden=120):
+    model = NN([X_train.shape[1], hidden, num_classes], learning_rate=lr, activation="relu", dtype=np.float32,
+               loss="cross_entropy")
+    for epoch in range(epochs):
+        loss = model.fit(X_train.astype(np.float32), y_train, epochs=1, batch_size=batch_size, seed=epoch, verbose=False)[0]
+        val_acc = (model.predict(X_test.astype(np.float32)) == y_test).mean()
+        print(f"Epoch {epoch+1}/{epochs} - Train loss: {loss:.4f} - Validation acc: {val_acc:.4f}")
+    return model, float(val_acc)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cache frozen-backbone embeddings and train heads on them.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    extract = subparsers.add_parser("extract", help="Embed the images of a dataset CSV that are not cached yet.")
+    head = subparsers.add_parser("train", help="Train a head on cached embeddings.")
+    for sub in (extract, head):
+        sub.add_argument("--csv", default="../output_224.csv", help="Dataset CSV written by dataset.py")
+        sub.add_argument("--store", required=True)
+    extract.add_argument("--backbone", default="cnn", help="cnn, or a torchvision model name such as resnet18")
+    extract.add_argument("--weights", default=None, help="state_dict from train.py --save (cnn backbone only)")
+    extract.add_argument("--pool", type=int, default=1, help="Pooled map size for the cnn backbone (14 = no pooling).")
+    extract.add_argument("--batch-size", type=int, default=64)
+    extract.add_argument("--num-workers", type=int, default=0)
+    extract.add_argument("--threads", type=int, default=None)
+    head.add_argument("--head", choices=["fcl", "nn"], default="fcl")
+    head.add_argument("--epochs", type=int, default=20)
+    head.add_argument("--lr", type=float, default=None)
+    head.add_argument("--batch-size", type=int, default=256)
+    head.add_argument("--test-size", type=float, default=0.2)
+    head.add_argument("--seed", type=int, default=None)
+    head.add_argument("--save", default=None, help="Write the trained head here (torch state_dict or NN.save).")
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.csv)
+    store = EmbeddingStore(args.store)
+    if args.command == "extract":
+        if args.threads:
+            torch.set_num_threads(args.threads)
+        backbone = Backbone(args.backbone, args.weights, args.pool)
+        computed = store.update(df.iloc[:, 0].tolist(), backbone, args.batch_size, args.num_workers)
+        print(f"Embedded {computed} distinct images for {len(df)} rows.")
+    else:
+        X = store.lookup(df.iloc[:, 0].tolist())
+        y = df.iloc[:, 1].to_numpy(dtype=np.int64)
+        num_classes = int(y.max()) + 1
+        train_idx, test_idx = split_indices(df, args.test_size, args.seed)
+        if args.head == "fcl":
+            model, val_acc = train_fcl(X[train_idx], y[train_idx], X[test_idx], y[test_idx], num_classes, args.epochs,
+                                       args.lr or 1e-3, batch_size=args.batch_size)
+            if args.save:
+                torch.save(model.state_dict(), args.save)
+        else:
+            model, val_acc = train_nn(X[train_idx], y[train_idx], X[test_idx], y[test_idx], num_classes, args.epochs,
+                                      args.lr or 0.01, args.batch_size)
+            if args.save:
+                model.save(args.save, input_kind=f"embeddings:{store.index['description']['backbone']}")
+        print(f"Validation accuracy: {val_acc:.4f}")
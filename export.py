@@ -0,0 +1,158 @@
+import torch, time, argparse, os, json
+import numpy as np
+import pandas as pd
+import torch.nn as nn
+from sklearn.model_selection import train_test_split
+from torch.utils.data import DataLoader
+
+from train import CNN, CustomCountriesDataset, tf
+from dataset import group_split
+
+"""
+CPU inference exports for a trained CNN (state_dict from train.py --save).
+
+python export.py --model model.pt --csv ../output_224.csv --out exports/ --quantization static
+
+Writes to --out:
+    cnn_fp32.ts.pt   TorchScript trace of the fp32 model
+    cnn.onnx         ONNX model with a dynamic batch dimension
+    cnn_int8.ts.pt   int8 model (TorchScript); "dynamic" quantizes only the Linear layers
+                     (the 512*14*14 -> 120 layer holds most of the weights), "static" quantizes
+                     convolutions too, calibrated on --calibration-batches of the training split
+    benchmark.json   accuracy, agreement with fp32 and images/s for fp32, int8 and ONNX Runtime
+"""
+
+INPUT_SHAPE = (3, 226, 226)  # 224x224 crops after tf's Pad(1)
+
+def load_model(path, num_classes):
+    model = CNN(num_classes=num_classes)
+    model.load_state_dict(torch.load(path, map_location="cpu"))
+    return model.eval()
+
+def split_loaders(csv, test_size=0.2, seed=0, batch_size=64, calibration_batches=10, eval_limit=None):
+    df = pd.read_csv(csv)
+    if "group" in df.columns:
+        train_idx, test_idx = group_split(df, test_size=test_size, seed=seed)
+        train_data, test_data = df.iloc[train_idx], df.iloc[test_idx]
+    else:
+        train_data, test_data = train_test_split(df, test_size=test_size, random_state=seed)
+    calibration = CustomCountriesDataset(train_data.iloc[:calibration_batches * batch_size], transform=tf)
+    evaluation = CustomCountriesDataset(test_data if eval_limit is None else test_data.iloc[:eval_limit], transform=tf)
+    return (DataLoader(calibration, batch_size=batch_size, num_workers=2),
+            DataLoader(evaluation, batch_size=batch_size, num_workers=2))
+
+def export_torchscript(model, path):
+    example = torch.randn(1, *INPUT_SHAPE)
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(model, example))
+    traced.save(path)
+    return traced
+
+def export_onnx(model, path, opset=17):
+    example = torch.randn(1, *INPUT_SHAPE)
+    torch.onnx.export(model, example, path, input_names=["image"], output_names=["probabilities"],
+                      dynamic_axes={"image": {0: "batch"}, "probabilities": {0: "batch"}}, opset_version=opset)
+
+def quantize_dynamic(model):
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+def quantize_static(model, calibration_loader, backend="x86"):
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    torch.backends.quantized.engine = backend
+    example = (torch.randn(1, *INPUT_SHAPE),)
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), example)
+    with torch.no_grad():
+        for X_batch, _ in calibration_loader:
+            prepared(X_batch)
+    return convert_fx(prepared)
+
+def run_torch(model, loader):
+    predictions, labels, elapsed = [], [], 0.0
+    with torch.no_grad():
+        for X_batch, y_batch in loader:
+            start = time.perf_counter()
+            pred = model(X_batch)
+            elapsed += time.perf_counter() - start
+            predictions.append(pred.argmax(dim=1).numpy())
+            labels.append(y_batch.numpy())
+    return np.concatenate(predictions), np.concatenate(labels), elapsed
+
+def run_onnx(path, loader, threads=None):
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    if threads:
+        options.intra_op_num_threads = threads
+    session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+    predictions, labels, elapsed = [], [], 0.0
+    for X_batch, y_batch in loader:
+        inputs = {"image": X_batch.numpy()}
+        start = time.perf_counter()
+        (pred,) = session.run(None, inputs)
+        elapsed += time.perf_counter() - start
+        predictions.append(pred.argmax(axis=1))
+        labels.append(y_batch.numpy())
+    return np.concatenate(predictions), np.concatenate(labels), elapsed
+
+def benchmark(variants, loader):
+    """
+    variants maps a name to a callable(loader) -> (predictions, labels, seconds). The first variant is the reference.
+    Only model time is counted, not data loading.
+    """
+    results, reference = {}, None
+    for name, run in variants.items():
+        predictions, labels, elapsed = run(loader)
+        if reference is None:
+            reference = predictions
+        results[name] = {"accuracy": float((predictions == labels).mean()),
+                         "agreement_with_fp32": float((predictions == reference).mean()),
+                         "images_per_second": len(labels) / elapsed}
+        print(f"{name:10s} acc {results[name]['accuracy']:.4f}  agree {results[name]['agreement_with_fp32']:.4f}  "
+              f"{results[name]['images_per_second']:.1f} images/s")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export and benchmark CPU inference variants of the CNN.")
+    parser.add_argument("--model", required=True, help="state_dict saved by train.py --save")
+    parser.add_argument("--csv", default="../output_224.csv")
+    parser.add_argument("--num-classes", type=int, default=None)
+    parser.add_argument("--out", default="exports")
+    parser.add_argument("--quantization", choices=["dynamic", "static"], default="dynamic")
+    parser.add_argument("--calibration-batches", type=int, default=10)
+    parser.add_argument("--eval-limit", type=int, default=2000, help="Images of the test split to benchmark on.")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the train/test split.")
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    os.makedirs(args.out, exist_ok=True)
+    num_classes = args.num_classes or int(pd.read_csv(args.csv).iloc[:, 1].max()) + 1
+    model = load_model(args.model, num_classes)
+    calibration_loader, eval_loader = split_loaders(args.csv, seed=args.seed, batch_size=args.batch_size,
+                                                    calibration_batches=args.calibration_batches,
+                                                    eval_limit=args.eval_limit)
+
+    fp32_path = os.path.join(args.out, "cnn_fp32.ts.pt")
+    onnx_path = os.path.join(args.out, "cnn.onnx")
+    int8_path = os.path.join(args.out, "cnn_int8.ts.pt")
+    traced = export_torchscript(model, fp32_path)
+    export_onnx(model, onnx_path)
+    if args.quantization == "dynamic":
+        quantized = quantize_dynamic(model)
+    else:
+        quantized = quantize_static(model, calibration_loader)
+    quantized_traced = export_torchscript(quantized, int8_path)
+    print(f"Wrote {fp32_path}, {onnx_path}, {int8_path}")
+
+    results = benchmark({
+        "fp32": lambda loader: run_torch(model, loader),
+        "fp32_ts": lambda loader: run_torch(traced, loader),
+        "int8": lambda loader: run_torch(quantized_traced, loader),
+        "onnxruntime": lambda loader: run_onnx(onnx_path, loader, args.threads),
+    }, eval_loader)
+    results["quantization"] = args.quantization
+    results["sizes_mb"] = {os.path.basename(p): os.path.getsize(p) / 1024**2 for p in (fp32_path, onnx_path, int8_path)}
+    with open(os.path.join(args.out, "benchmark.json"), "w") as f:
+        json.dump(results, f, indent=2)
@@ -0,0 +1,225 @@
+import os, json, time, math, sqlite3, asyncio, argparse
+import pandas as pd
+
+import metrics
+
+"""
+Reverse geocoding against the bundled Nominatim instance (nominatim-docker, port 8080 by default).
+
+Coordinates are snapped to a grid cell (grid degrees, 0.01 ~ 1 km) and each cell is looked up once:
+results live in a SQLite cache, so re-labelling the index only queries cells never seen before.
+Requests share one pooled aiohttp session and at most max_concurrency are in flight at a time.
+
+python geocode.py ../output_224.csv --coords ../coords.csv --url http://localhost:8080 --level state
+
+The cache defaults to ../geocode.sqlite, alongside the index.
+
+The index needs lat and lon columns; pass --coords to merge them in from a CSV with images, lat, lon
+columns. The captures do not record coordinates yet, so rows without them get no region. Anything that
+answers GET /reverse?lat=..&lon=..&format=jsonv2 like Nominatim works as --url, e.g. a local stub server.
+"""
+
+# Address fields tried in order when the requested level is missing (small countries have no state).
+REGION_FALLBACK = ("state", "region", "province", "county", "city", "country")
+
+def grid_cell(lat, lon, grid=0.01):
+    # Center of the grid cell holding (lat, lon); also the point that is actually geocoded.
+    return (round((math.floor(lat / grid) + 0.5) * grid, 6), round((math.floor(lon / grid) + 0.5) * grid, 6))
+
+class GeocodeCache():
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS reverse "
+                                "(key TEXT PRIMARY KEY, response TEXT NOT NULL, fetched REAL NOT NULL)")
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        row = self.connection.execute("SELECT response FROM reverse WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            metrics.count("geocode.cache_misses")
+            return None
+        self.hits += 1
+        metrics.count("geocode.cache_hits")
+        return json.loads(row[0])
+
+    def put(self, key, response):
+        self.connection.execute("INSERT OR REPLACE INTO reverse VALUES (?, ?, ?)", (key, json.dumps(response), time.time()))
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM reverse").fetchone()[0]
+
+class ReverseGeocoder():
+    """
+    async with ReverseGeocoder("http://localhost:8080", cache_path="geocode.sqlite") as geocoder:
+        results = await geocoder.reverse_many([(25.03, 121.56), ...])
+
+    Results are Nominatim jsonv2 responses (dicts with an "address" field), or {"error": ...} for points
+    Nominatim cannot place. Transport errors are retried and, if they persist, give None and are not cached.
+    """
+    def __init__(self, base_url="http://localhost:8080", cache_path="geocode.sqlite", max_concurrency=8,
+                 grid=0.01, zoom=10, timeout=10, retries=3, language="en"):
+        self.base_url = base_url.rstrip("/")
+        self.cache = GeocodeCache(cache_path)
+        self.max_concurrency = max_concurrency
+        self.grid = grid
+        self.zoom = zoom
+        self.timeout = timeout
+        self.retries = retries
+        self.language = language
+        self.session = None
+        self.semaphore = None
+        self.inflight = {}
+        self.requests = 0
+        self.errors = 0
+
+    async def __aenter__(self):
+        import aiohttp
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                                             timeout=aiohttp.ClientTimeout(total=self.timeout),
+                                             headers={"Accept-Language": self.language})
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+        self.cache.close()
+
+    def _key(self, cell):
+        return f"{cell[0]:.6f},{cell[1]:.6f},{self.zoom}"
+
+    async def _fetch(self, cell):
+        import aiohttp
+        params = {"lat": cell[0], "lon": cell[1], "format": "jsonv2", "zoom": self.zoom, "addressdetails": 1}
+        for attempt in range(self.retries + 1):
+            async with self.semaphore:
+                start = time.perf_counter()
+                try:
+                    async with self.session.get(f"{self.base_url}/reverse", params=params) as response:
+                        response.raise_for_status()
+                        result = await response.json(content_type=None)
+                    return result
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    error = e
+                finally:
+                    self.requests += 1
+                    metrics.observe("geocode.request", time.perf_counter() - start)
+            if attempt < self.retries:
+                await asyncio.sleep(0.5 * 2 ** attempt)
+        self.errors += 1
+        metrics.count("geocode.errors")
+        print(f"Reverse geocoding {cell} failed: {error}")
+        return None
+
+    async def _lookup(self, cell):
+        key = self._key(cell)
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+        # Concurrent callers asking for the same cell share one request.
+        if key not in self.inflight:
+            self.inflight[key] = asyncio.ensure_future(self._fetch(cell))
+        task = self.inflight[key]
+        try:
+            result = await task
+        finally:
+            self.inflight.pop(key, None)
+        if result is not None:
+            self.cache.put(key, result)
+        return result
+
+    async def reverse(self, lat, lon):
+        return await self._lookup(grid_cell(lat, lon, self.grid))
+
+    async def reverse_many(self, coords):
+        """
+        Geocode a list of (lat, lon); each distinct grid cell is looked up once. Results are in input order.
+        """
+        cells = [grid_cell(lat, lon, self.grid) for lat, lon in coords]
+        unique = list(dict.fromkeys(cells))
+        results = await asyncio.gather(*(self._lookup(cell) for cell in unique))
+        self.cache.commit()
+        by_cell = dict(zip(unique, results))
+        return [by_cell[cell] for cell in cells]
+
+    def stats(self):
+        lookups = self.cache.hits + self.cache.misses
+        return {"lookups": lookups, "cache_hits": self.cache.hits, "cache_misses": self.cache.misses,
+                "hit_rate": self.cache.hits / lookups if lookups else 0.0,
+                "requests": self.requests, "errors": self.errors, "cached_cells": len(self.cache)}
+
+def region_label(result, level="state"):
+    if not result or "address" not in result:
+        return None
+    address = result["address"]
+    for field in (level,) + tuple(f for f in REGION_FALLBACK if f != level):
+        if address.get(field):
+            return address[field]
+    return None
+
+"""
+Add a region column to a dataset index with lat and lon columns. Rows without coordinates (or that
+Nominatim cannot place) get None. Returns (df, stats).
+"""
+def label_index(df, base_url="http://localhost:8080", cache_path="geocode.sqlite", level="state",
+                max_concurrency=8, grid=0.01, zoom=10):
+    if "lat" not in df.columns or "lon" not in df.columns:
+        raise ValueError("The index has no lat/lon columns; merge them in first (see --coords).")
+    has_coords = df["lat"].notna() & df["lon"].notna()
+    coords = list(zip(df.loc[has_coords, "lat"], df.loc[has_coords, "lon"]))
+
+    async def run():
+        async with ReverseGeocoder(base_url, cache_path, max_concurrency, grid, zoom) as geocoder:
+            results = await geocoder.reverse_many(coords)
+            return results, geocoder.stats()
+
+    with metrics.timer("geocode.label_index"):
+        results, stats = asyncio.run(run())
+    df = df.copy()
+    df["region"] = None
+    df.loc[has_coords, "region"] = [region_label(result, level) for result in results]
+    print(f"Labelled {df['region'].notna().sum()} of {len(df)} images; "
+          f"{stats['cache_hits']} cache hits, {stats['requests']} requests, hit rate {stats['hit_rate']:.1%}")
+    return df, stats
+
+def _read(path):
+    return pd.read_parquet(path) if path.endswith(".parquet") else pd.read_csv(path)
+
+def _write(df, path):
+    if path.endswith(".parquet"):
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Label a dataset index with Nominatim regions.")
+    parser.add_argument("index", help="CSV or Parquet index written by dataset.py")
+    parser.add_argument("--coords", default=None, help="CSV with images, lat, lon columns to merge into the index.")
+    parser.add_argument("--out", default=None, help="Defaults to overwriting the index.")
+    parser.add_argument("--url", default="http://localhost:8080")
+    # Next to the images and indexes in the parent directory, not inside the repository.
+    parser.add_argument("--cache", default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                        "geocode.sqlite"))
+    parser.add_argument("--level", default="state", help="Nominatim address field to use as the region.")
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    parser.add_argument("--grid", type=float, default=0.01, help="Grid cell size in degrees.")
+    parser.add_argument("--zoom", type=int, default=10)
+    args = parser.parse_args()
+
+    df = _read(args.index)
+    if args.coords:
+        df = df.drop(columns=[c for c in ("lat", "lon") if c in df.columns])
+        df = df.merge(pd.read_csv(args.coords)[["images", "lat", "lon"]], on="images", how="left")
+    df, stats = label_index(df, args.url, args.cache, args.level, args.max_concurrency, args.grid, args.zoom)
+    _write(df, args.out or args.index)
+    print(json.dumps(stats, indent=2))
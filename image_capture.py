@@ -1,7 +1,12 @@
-import time, getpass, selenium, os
+import time, getpass, selenium, os, io, json
 import numpy as np
 from datetime import datetime
 from tqdm import tqdm
+from PIL import Image
+
+from image_processing import black_ratio
+from capture_writer import CaptureWriter
+import metrics
 
 from selenium import webdriver
 from selenium.webdriver.common.by import By
@@ -32,20 +37,47 @@ A class that initializes a webdriver (browser) instance.
 Attributes:
 username (str) - The user's GeoGuessr username.
 password (str) - The user's GeoGuessr password.
+save_path (str) - Parent folder; screenshots go to save_path/<country>.
+headless (bool) - Run Chrome without a window (needed to run several browsers side by side).
+game_link (str) - Base URL of the game, so a local mock page can stand in for geoguessr.com.
+before_round, after_round (callable) - Optional hooks called around every round, e.g. for rate limiting and progress.
+capture_mode (str) - "png" saves full screenshots to save_path/<country> for image_processing.py.
+    "memory" keeps them in memory and has the writer black-check, crop and encode them straight to
+    save_path/<country><w>x<h>, the folder image_processing.py would have produced.
+crop_size (tuple) - (width, height) of the crops in "memory" mode.
+keep_png (bool) - In "memory" mode, also keep the raw screenshot in save_path/<country>_pngs.
+writer (CaptureWriter) - Shared background writer. If omitted, the browser starts (and closes) its own.
 """
 class Browser():
-    def __init__(self, username, password, save_path, home_link="https://www.google.com"):
+    def __init__(self, username, password, save_path, home_link="https://www.google.com", headless=False,
+                 game_link="https://www.geoguessr.com", before_round=None, after_round=None,
+                 capture_mode="png", crop_size=(224, 224), keep_png=False, writer=None):
         self.username = username
         self.password = password
         self.save_path = save_path
         self.home_link = home_link
+        self.game_link = game_link
+        self.before_round = before_round
+        self.after_round = after_round
+        self.owns_writer = writer is None
+        self.writer = writer if writer is not None else CaptureWriter(save_path, mode=capture_mode,
+                                                                       crop_size=crop_size, keep_png=keep_png)
+        # Game state, so an interrupted start_game can be resumed.
+        self.rounds_left = 0
+        self.round_in_game = 0
+        self.hud_hidden = False
         self.chrome_options = webdriver.ChromeOptions()
         self.chrome_options.add_argument("--mute-audio")
+        if headless:
+            self.chrome_options.add_argument("--headless=new")
+            # maximize_window is a no-op without a window manager; fix the size the screenshots are taken at.
+            self.chrome_options.add_argument("--window-size=1920,1080")
         # Open an instance of Chrome and navigate to google.com.  Throw an error if not initialized.
         try:
-            self.driver = webdriver.Chrome(options=self.chrome_options)
-            self.driver.maximize_window()
-            self.driver.get(home_link)
+            with metrics.timer("capture.chrome_start"):
+                self.driver = webdriver.Chrome(options=self.chrome_options)
+                self.driver.maximize_window()
+                self.driver.get(home_link)
             if self.driver.title:
                 #print(f"Web driver initialized and navigated to home: {home_link}.")
                 pass
@@ -152,22 +184,21 @@ class Browser():
 
 
     """
-    Start browsing GeoGuessr.
+    Navigate to the map and log in (accepting cookies first).
     """
-    def start_game(self, country, num_images):
-        country = country.lower()
-        geoguessr_link = f"https://www.geoguessr.com/maps/{country}/play"
+    def login(self, country, accept_cookies=True):
+        geoguessr_link = f"{self.game_link}/maps/{country.lower()}/play"
 
         # Navigate to desired map.
         self.driver.get(geoguessr_link)
 
-        # Accept cookies
-        cookies_xpath = "/html/body/div[2]/div[2]/div/div/div[2]/div/div/button"
-        self.click_button_by_xpath(xpath=cookies_xpath)
+        # Accept cookies (already accepted if the consent cookie was restored)
+        if accept_cookies:
+            cookies_xpath = "/html/body/div[2]/div[2]/div/div/div[2]/div/div/button"
+            self.click_button_by_xpath(xpath=cookies_xpath)
 
         # Click login button
-        login_xpath = "/html/body/div[1]/div/div[2]/div[1]/div[2]/header/div[2]/div[2]/a"
-        self.click_button_by_xpath(xpath=login_xpath)
+        self.click_button_by_xpath(xpath=self.login_xpath)
 
         # Enter GG username
         username_field = "/html/body/div[1]/div/div[2]/div[1]/main/div/div/form/div/div[1]/div[2]/input"
@@ -180,7 +211,53 @@ class Browser():
         # Submit form
         userpass_xpath = "/html/body/div[1]/div/div[2]/div[1]/main/div/div/form/div/div[3]/div[1]/div/button"
         self.click_button_by_xpath(userpass_xpath)
-        
+
+    login_xpath = "/html/body/div[1]/div/div[2]/div[1]/div[2]/header/div[2]/div[2]/a"
+
+    """
+    Check whether the current page shows the login link, waiting briefly for it to render.
+    """
+    def is_logged_in(self, timeout=5):
+        try:
+            WebDriverWait(self.driver, timeout=timeout).until(
+                EC.visibility_of_element_located((By.XPATH, self.login_xpath))
+            )
+        except sce.TimeoutException:
+            return True
+        return False
+
+    """
+    Save the session cookies to disk so later browsers can skip the login.
+    """
+    def save_cookies(self, path):
+        with open(path, "w") as f:
+            json.dump(self.driver.get_cookies(), f)
+
+    """
+    Restore cookies saved by save_cookies. Returns False if there is nothing to restore.
+    """
+    def load_cookies(self, path):
+        if not os.path.exists(path):
+            return False
+        with open(path) as f:
+            cookies = json.load(f)
+        # Cookies can only be set for the domain currently loaded.
+        self.driver.get(self.game_link)
+        for cookie in cookies:
+            try:
+                self.driver.add_cookie(cookie)
+            except sce.WebDriverException:
+                pass
+        return True
+
+    """
+    Open the map page and start a new game with NMPZ settings.
+    """
+    def new_game(self, country):
+        geoguessr_link = f"{self.game_link}/maps/{country.lower()}/play"
+        if self.driver.current_url != geoguessr_link:
+            self.driver.get(geoguessr_link)
+
         # Game settings
         # Make sure settings are default
         move_setting = "/html/body/div[1]/div[2]/div[2]/div[1]/main/div/div/div/div/div[5]/div/div[2]/div/div[2]/label[1]/div[3]/input"
@@ -198,47 +275,171 @@ class Browser():
         # Start the game.
         start_game = "/html/body/div[1]/div[2]/div[2]/div[1]/main/div/div/div/div/div[3]/div/div/button"
         self.click_button_by_xpath(start_game)
+        self.round_in_game = 0
+        self.hud_hidden = False
 
-        progress_bar = tqdm(total=num_images, desc="Image capture progress")
-        for i in range(int(num_images/5)):
-            # Delete game status (top right)
-            self.delete_element("game_status__q_b7N")
-            # Delete game controls (bottom left)
-            self.delete_element("game_controls___pIfC")
-            # Delete top HUD
-            self.delete_element("game_topHud__tAKJD")
-            
-            # Play 5 rounds
-            for _ in range(5):
-                self.play_round(country)
-                WebDriverWait(self.driver, timeout=10).until(
-                    EC.visibility_of_element_located((By.CLASS_NAME, "round-result_wrapper__V1VCe"))
-                )
+    """
+    Hide the HUD so it is not in the screenshots.
+    """
+    def hide_hud(self):
+        # Delete game status (top right)
+        self.delete_element("game_status__q_b7N")
+        # Delete game controls (bottom left)
+        self.delete_element("game_controls___pIfC")
+        # Delete top HUD
+        self.delete_element("game_topHud__tAKJD")
+        self.hud_hidden = True
+
+    """
+    Read the current round (0-based) from the game status, or None if it is not shown.
+    """
+    def current_round(self):
+        try:
+            text = self.driver.find_element(By.CSS_SELECTOR, "[data-qa='round-number']").text
+            return int(text.split("/")[0].split()[-1]) - 1
+        except (sce.NoSuchElementException, ValueError, IndexError):
+            return None
+
+    """
+    Play rounds until rounds_left reaches zero. Safe to call again after an interruption:
+    the counters only advance once a round has been submitted.
+    """
+    def play_games(self, country, show_progress=True):
+        progress_bar = tqdm(total=self.rounds_left, desc="Image capture progress", disable=not show_progress)
+        while self.rounds_left > 0:
+            if not self.hud_hidden:
+                self.hide_hud()
+
+            if self.before_round is not None:
+                self.before_round()
+            self.play_round(country)
+            WebDriverWait(self.driver, timeout=10).until(
+                EC.visibility_of_element_located((By.CLASS_NAME, "round-result_wrapper__V1VCe"))
+            )
+            self.round_in_game += 1
+            self.rounds_left -= 1
+            progress_bar.update(1)
+            if self.after_round is not None:
+                self.after_round()
+
+            if self.round_in_game < 5:
                 self.press_key(Keys.SPACE)
-                progress_bar.update(1)
+                continue
 
+            # End of a 5-round game: play again.
             WebDriverWait(self.driver, timeout=10).until(
                 EC.visibility_of_element_located((By.XPATH, 
                                                   "/html/body/div[1]/div[2]/div[2]/main/div[2]/div/div[2]/div/div[2]/div[3]/div/div/button")))
             self.press_key(Keys.SPACE)
-        
-        
+            self.round_in_game = 0
+            self.hud_hidden = False
         progress_bar.close()
+
+    """
+    Continue an interrupted game after a soft failure: reload the page, which GeoGuessr
+    brings back at the unfinished round, and carry on from there.
+    """
+    def resume(self, country, show_progress=True):
+        if self.round_in_game == 0:
+            # Failed between games; the summary page has nothing to resume.
+            self.new_game(country)
+        else:
+            self.driver.refresh()
+            self.hud_hidden = False
+            WebDriverWait(self.driver, timeout=15).until(
+                EC.presence_of_element_located((By.CLASS_NAME, "game_status__q_b7N"))
+            )
+            # Trust the page over our counter if the round was submitted just before the failure.
+            page_round = self.current_round()
+            if page_round is not None and page_round != self.round_in_game:
+                self.rounds_left -= page_round - self.round_in_game
+                self.round_in_game = page_round
+        self.play_games(country, show_progress)
+
+    """
+    Start browsing GeoGuessr.
+    """
+    def start_game(self, country, num_images, show_progress=True, login=True):
+        country = country.lower()
+        with metrics.timer("capture.start_game"):
+            if login:
+                with metrics.timer("capture.login"):
+                    self.login(country)
+            self.new_game(country)
+            self.rounds_left = 5 * int(num_images/5)
+            self.play_games(country, show_progress)
         print("Finished.")
     
+    """
+    Take a screenshot and return (png_bytes, small grayscale thumbnail as a float array).
+    """
+    def grab(self, reduce_factor=16):
+        with metrics.timer("capture.screenshot"):
+            png = self.driver.get_screenshot_as_png()
+        metrics.add_bytes("capture.screenshot", len(png))
+        with Image.open(io.BytesIO(png)) as image:
+            thumbnail = image.convert('L').reduce(reduce_factor)
+        return png, np.asarray(thumbnail, dtype=np.float32)
+
+    """
+    Wait until the panorama has rendered: a canvas is on the page, and two successive
+    low-resolution grabs agree and are not black. Returns the PNG bytes of the last grab,
+    or None if the panorama did not settle within timeout seconds on any attempt.
+    """
+    def wait_for_panorama(self, timeout=6, poll=0.25, tolerance=2.0, retries=1):
+        for attempt in range(retries + 1):
+            try:
+                WebDriverWait(self.driver, timeout=timeout, poll_frequency=poll).until(
+                    lambda driver: driver.execute_script(
+                        "return Array.from(document.querySelectorAll('canvas')).some(c => c.width > 0 && c.height > 0);")
+                )
+            except sce.TimeoutException:
+                continue
+            deadline = time.monotonic() + timeout
+            previous = None
+            while time.monotonic() < deadline:
+                png, thumbnail = self.grab()
+                if previous is not None and black_ratio(Image.fromarray(thumbnail.astype(np.uint8))) <= 0.95 \
+                        and np.abs(thumbnail - previous).mean() < tolerance:
+                    return png
+                previous = thumbnail
+                time.sleep(poll)
+        return None
+
+    """
+    Hand the screenshot to the background writer. Blocks only if the writer queue is full.
+    """
+    def save_capture(self, png, country):
+        self.writer.put(png, country)
+
+    """
+    Flush outstanding writes (if this browser owns its writer) and close Chrome.
+    """
+    def quit(self):
+        try:
+            if self.owns_writer:
+                self.writer.close()
+                self.writer.report()
+        finally:
+            self.driver.quit()
+
     """
     Play one round of Geoguessr, and display the result.
     """
     def play_round(self, country):
+        start = time.perf_counter()
         # Delete map.
         self.delete_element("game_guessMap__MTlQ_")
-        time.sleep(2) # Ensure picture load
-        # Save screenshot
-        timestamp = datetime.now().strftime("%m.%d.%Y_%H%M%S")
-        screenshot_path = os.path.join(self.save_path, country)
-        if not os.path.exists(screenshot_path):
-            os.makedirs(screenshot_path)
-        self.driver.save_screenshot(os.path.join(screenshot_path, f"{timestamp}_{country}.png"))
+        # Wait for the picture to load; the last stable grab is the screenshot.
+        with metrics.timer("capture.panorama_wait"):
+            png = self.wait_for_panorama()
+        if png is None:
+            # Never loaded: skip the capture rather than write a black frame, but still finish the round.
+            metrics.count("capture.panorama_timeouts")
+            print("Panorama did not load, skipping screenshot.")
+        else:
+            with metrics.timer("capture.enqueue"):
+                self.save_capture(png, country)
         self.restore_element("game_guessMap__MTlQ_") # Restore map visibility for the next round.
         # Click map.
         map_xpath = "/html/body/div[1]/div[2]/div[2]/main/div/div/div[4]/div/div[3]/div/div/div/div[3]/div[1]/div[2]"
@@ -248,8 +449,113 @@ class Browser():
         )
         # Submit the guess.
         self.press_key(Keys.SPACE)
+        metrics.observe("capture.round", time.perf_counter() - start)
+        metrics.count("capture.rounds")
 
 
+"""
+Failures a page reload can recover from. Anything else (e.g. Chrome crashed, session gone) restarts Chrome.
+"""
+SOFT_FAILURES = (sce.TimeoutException, sce.NoSuchElementException, sce.StaleElementReferenceException,
+                 sce.ElementClickInterceptedException, sce.ElementNotInteractableException,
+                 sce.MoveTargetOutOfBoundsException, sce.JavascriptException)
+
+"""
+A long-lived capture session: one Chrome instance that logs in once, persists its cookies to
+cookie_path and keeps playing. Soft failures reload the page and resume the interrupted game at the
+right round; only hard failures (or repeated soft ones) restart Chrome, which then reuses the cookies.
+"""
+class CaptureSession():
+    def __init__(self, username, password, save_path, cookie_path, max_soft_retries=3, max_restarts=10,
+                 backoff=5.0, max_backoff=300.0, **browser_kwargs):
+        self.username = username
+        self.password = password
+        self.save_path = save_path
+        self.cookie_path = cookie_path
+        self.max_soft_retries = max_soft_retries
+        # Chrome restarts in a row (without a round completing in between) before run() gives up.
+        self.max_restarts = max_restarts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.browser_kwargs = browser_kwargs
+        self.browser = None
+        self.restarts = 0
+
+    def open(self, country, rounds_left):
+        self.browser = Browser(self.username, self.password, self.save_path, **self.browser_kwargs)
+        self.browser.rounds_left = rounds_left
+        restored = self.browser.load_cookies(self.cookie_path)
+        if restored:
+            self.browser.driver.get(f"{self.browser.game_link}/maps/{country}/play")
+        # Saved cookies may have expired; fall back to a full login.
+        if not restored or not self.browser.is_logged_in():
+            self.browser.login(country, accept_cookies=not restored)
+            self.browser.save_cookies(self.cookie_path)
+        self.browser.new_game(country)
+
+    def close(self):
+        if self.browser is not None:
+            try:
+                self.browser.quit()
+            except Exception:
+                pass
+            self.browser = None
+
+    """
+    Capture num_images rounds of country, surviving failures along the way. Can be called again with
+    the same session for the next batch; Chrome stays open between batches.
+    Raises RuntimeError after max_restarts Chrome restarts in a row.
+    """
+    def run(self, country, num_images, show_progress=True):
+        country = country.lower()
+        rounds_left = 5 * int(num_images/5)
+        soft_retries = 0
+        consecutive_restarts = 0
+        # A browser left over from the previous batch starts a new game rather than resuming the old one.
+        fresh_batch = True
+        while rounds_left > 0:
+            failure = None
+            try:
+                if self.browser is None:
+                    self.open(country, rounds_left)
+                    self.browser.play_games(country, show_progress)
+                elif fresh_batch:
+                    self.browser.rounds_left = rounds_left
+                    self.browser.new_game(country)
+                    self.browser.play_games(country, show_progress)
+                else:
+                    self.browser.resume(country, show_progress)
+            except SOFT_FAILURES as e:
+                failure = "soft"
+                soft_retries += 1
+                metrics.count("capture.soft_failures")
+                print(f"Soft failure ({type(e).__name__}), reloading page ({soft_retries}/{self.max_soft_retries}).")
+            except sce.WebDriverException as e:
+                failure = "hard"
+                metrics.count("capture.hard_failures")
+                print(f"Hard failure ({type(e).__name__}), restarting Chrome.")
+            else:
+                soft_retries = 0
+            fresh_batch = False
+            if self.browser is not None:
+                if self.browser.rounds_left < rounds_left:
+                    consecutive_restarts = 0
+                rounds_left = self.browser.rounds_left
+            if failure == "hard" or soft_retries > self.max_soft_retries:
+                self.close()
+                self.restarts += 1
+                consecutive_restarts += 1
+                metrics.count("capture.restarts")
+                soft_retries = 0
+                if consecutive_restarts > self.max_restarts:
+                    raise RuntimeError(f"Chrome failed {consecutive_restarts} times in a row, giving up "
+                                       f"with {rounds_left} rounds left.")
+                # Back off exponentially so a Chrome that cannot start does not spin.
+                delay = min(self.backoff * 2 ** (consecutive_restarts - 1), self.max_backoff)
+                print(f"Restarting Chrome in {delay:.0f} s ({consecutive_restarts}/{self.max_restarts}).")
+                time.sleep(delay)
+        print("Finished.")
+
 """
 Grabs user's credentials to log into website.
 
@@ -293,23 +599,23 @@ if __name__ == "__main__":
     overnight = True
     batches = 40
     batch_size = 500
+    # "memory" writes 224x224 crops directly (no PNG -> JPG pass needed); "png" keeps the full screenshots.
+    capture_mode = "png"
     
     # The parent GG path. Sub-dirs are automatically created for ea. country.
     save_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     print(save_path)
 
-    if overnight:
-        while overnight:
-            try:
-                for i in tqdm(range(batches), desc="Total batch progress", miniters=0):
-                    data_acq = Browser(username, password, save_path)
-                    data_acq.start_game(country=country, num_images=batch_size)
-            except:
-                pass
-            finally:
-                data_acq.driver.quit()
-    else:
-        for i in tqdm(range(batches), desc="Total batch progress", miniters=0):
-            data_acq = Browser(username, password, save_path)
-            data_acq.start_game(country=country, num_images=batch_size)
-            data_acq.driver.quit()
\ No newline at end of file
+    # One Chrome for all batches. Cookies from the first login are reused if Chrome has to be restarted.
+    cookie_path = os.path.join(save_path, "geoguessr_cookies.json")
+    session = CaptureSession(username, password, save_path, cookie_path, capture_mode=capture_mode)
+    try:
+        while True:
+            for i in tqdm(range(batches), desc="Total batch progress", miniters=0):
+                session.run(country=country, num_images=batch_size)
+            if not overnight:
+                break
+    finally:
+        session.close()
+        print(metrics.summary())
+        metrics.write_report(os.path.join(save_path, "metrics", f"capture_{datetime.now().strftime('%m.%d.%Y_%H%M%S')}.json"))
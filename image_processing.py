@@ -1,8 +1,13 @@
 from PIL import Image
 from tqdm import tqdm
-import os, shutil, sys, getpass
-from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import os, io, shutil, sys, time, getpass
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import multiprocessing
+
+from manifest import Manifest
+from dedup import remove_duplicates
+import metrics
 """
 IMPORTANT:
 After image capture, your directory set up should look like this.
@@ -24,18 +29,87 @@ Your_parent_directory/
     ├── Image2.jpg
     └── ...
 """
-def convert_png_to_jpg(path):
-    image_names = os.listdir(path)
-    image_names = [name for name in image_names if name.endswith(".png")]
+def convert_png_to_jpg(path, manifest=None):
+    if manifest is not None:
+        image_names = manifest.pending("convert", path, ".png")
+    else:
+        image_names = os.listdir(path)
+        image_names = [name for name in image_names if name.endswith(".png")]
     def convert_image(name):
-        image = Image.open(os.path.join(path, name))
-        rgb_image = image.convert('RGB')
-        new_name = name.split(".png")[0] + ".jpg"
-        rgb_image.save(os.path.join(path, new_name))
-    with ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
-        list(tqdm(executor.map(convert_image, image_names), total=len(image_names), desc="PNG to JPG conversion progress", unit="pics"))
-
-def resize(folder_path, output_path, width, height):
+        with metrics.timer("process.convert"):
+            image = Image.open(os.path.join(path, name))
+            rgb_image = image.convert('RGB')
+            new_name = name.split(".png")[0] + ".jpg"
+            rgb_image.save(os.path.join(path, new_name))
+        metrics.add_bytes("process.convert_read", os.path.getsize(os.path.join(path, name)))
+        metrics.add_bytes("process.convert_written", os.path.getsize(os.path.join(path, new_name)))
+        return name, new_name
+    with metrics.timer("process.convert_stage"), ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
+        results = list(tqdm(executor.map(convert_image, image_names), total=len(image_names), desc="PNG to JPG conversion progress", unit="pics"))
+    metrics.count("process.converted", len(results))
+    if manifest is not None:
+        manifest.record("convert", path, results)
+
+def center_crop(image, width, height):
+    # Get current dimensions
+    img_width, img_height = image.size
+
+    # Calculate cropping coordinates
+    left = (img_width - width) / 2
+    top = (img_height - height) / 2
+    right = left + width
+    bottom = top + height
+
+    return image.crop((left, top, right, bottom))
+
+"""
+Tiles are named <parent>__L<level>_<row>_<col>.jpg, where <parent> is the name (without extension) of
+the screenshot they were cut from. parent_id recovers it, so splits can keep all tiles of one
+screenshot together (see dataset.add_duplicate_groups).
+"""
+TILE_SEPARATOR = "__"
+
+def parent_id(path):
+    return os.path.splitext(os.path.basename(path))[0].split(TILE_SEPARATOR)[0]
+
+def tile_positions(length, size, overlap=0.25, count=None):
+    # Evenly spaced offsets covering [0, length) with at least `overlap` of a tile shared between neighbours.
+    if length < size:
+        return []
+    if count is None:
+        stride = max(1, int(size * (1 - overlap)))
+        count = -(-(length - size) // stride) + 1
+    if count == 1:
+        return [(length - size) // 2]
+    return [round(i * (length - size) / (count - 1)) for i in range(count)]
+
+def extract_tiles(image, width, height, overlap=0.25, grid=None, levels=(1,), threshold=10):
+    """
+    Cut width x height tiles from an already decoded image. For every reduce factor in levels the image is
+    box-downscaled with Image.reduce (1 = full resolution) and covered with a grid of tiles overlapping by
+    at least overlap; grid=(cols, rows) fixes the number of tiles per level instead. Black tiles are dropped.
+    Returns [(suffix, tile), ...] with suffix "L<level>_<row>_<col>".
+    """
+    image.load()
+    tiles = []
+    for level in levels:
+        scaled = image if level == 1 else image.reduce(level)
+        columns = tile_positions(scaled.width, width, overlap, grid[0] if grid else None)
+        rows = tile_positions(scaled.height, height, overlap, grid[1] if grid else None)
+        for r, top in enumerate(rows):
+            for c, left in enumerate(columns):
+                tile = scaled.crop((left, top, left + width, top + height)).convert('RGB')
+                if black_ratio(tile, threshold) > 0.95:
+                    continue
+                tiles.append((f"L{level}_{r}_{c}", tile))
+    return tiles
+
+def resize(folder_path, output_path, width, height, manifest=None, tile=False, overlap=0.25, grid=None, levels=(1,)):
+    """
+    Crop every JPG in folder_path into output_path. By default one center crop per image; with tile=True
+    each image is decoded once and cut into several tiles (see extract_tiles), multiplying the samples per
+    screenshot.
+    """
     folder_path # ./GGAI/country
     parent_folder = os.path.dirname(folder_path) # ./GGAI
     separator = "/" if "/" in folder_path else "\\"
@@ -44,50 +118,165 @@ def resize(folder_path, output_path, width, height):
     if not os.path.exists(output_path): 
         os.makedirs(output_path)
     
+    def tile_image(filename):
+        if filename.endswith(".jpg"):
+            input_path = os.path.join(folder_path, filename)
+            stem = os.path.splitext(filename)[0]
+            outputs = []
+            with metrics.timer("process.tile"):
+                with Image.open(input_path) as image:
+                    for suffix, cropped_image in extract_tiles(image, width, height, overlap, grid, levels):
+                        output_file_path = os.path.join(output_path, f"{stem}{TILE_SEPARATOR}{suffix}.jpg")
+                        cropped_image.save(output_file_path)
+                        outputs.append(output_file_path)
+            metrics.add_bytes("process.tile_read", os.path.getsize(input_path))
+            metrics.add_bytes("process.tile_written", sum(os.path.getsize(path) for path in outputs))
+            metrics.count("process.tiles", len(outputs))
+            return filename, outputs
+
     def resize_image(filename):
         if filename.endswith(".jpg"):
             input_path = os.path.join(folder_path, filename)
-            image = Image.open(input_path)
-            
-            # Get current dimensions
-            img_width, img_height = image.size
-            
-            # Calculate cropping coordinates
-            left = (img_width - width) / 2
-            top = (img_height - height) / 2
-            right = left + width
-            bottom = top + height
-            
-            # Cropping image
-            cropped_image = image.crop((left, top, right, bottom))
-            output_file_path = os.path.join(output_path, filename)
-            cropped_image.save(output_file_path)
-    with ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
-        list(tqdm(executor.map(resize_image, os.listdir(folder_path)), total=len(os.listdir(folder_path)), desc="Resizing images", unit="pics"))
-
-def is_black(image_path, threshold=10):
+            with metrics.timer("process.resize"):
+                image = Image.open(input_path)
+                cropped_image = center_crop(image, width, height)
+                output_file_path = os.path.join(output_path, filename)
+                cropped_image.save(output_file_path)
+            metrics.add_bytes("process.resize_read", os.path.getsize(input_path))
+            metrics.add_bytes("process.resize_written", os.path.getsize(output_file_path))
+            return filename, output_file_path
+    # Tiled and center-cropped outputs are tracked separately, so switching modes redoes every image.
+    stage = "tile" if tile else "resize"
+    if manifest is not None:
+        filenames = manifest.pending(stage, folder_path, ".jpg")
+    else:
+        filenames = os.listdir(folder_path)
+    with metrics.timer(f"process.{stage}_stage"), ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
+        results = list(tqdm(executor.map(tile_image if tile else resize_image, filenames), total=len(filenames),
+                            desc="Tiling images" if tile else "Resizing images", unit="pics"))
+    metrics.count("process.resized", sum(result is not None for result in results))
+    if manifest is not None:
+        manifest.record(stage, folder_path, [result for result in results if result is not None])
+
+def black_ratio(image, threshold=10):
+    # Fraction of pixels at or below the threshold, read off the grayscale histogram (computed in C).
+    grayscale = image if image.mode == 'L' else image.convert('L')
+    histogram = np.asarray(grayscale.histogram())
+    return histogram[:threshold + 1].sum() / histogram.sum()
+
+def is_black(image_path, threshold=10, draft_size=(256, 256)):
     with Image.open(image_path) as img:
-        grayscale = img.convert('L')  # Convert to grayscale
-        black_pixels = sum(1 for pixel in grayscale.getdata() if pixel <= threshold)
-        total_pixels = grayscale.size[0] * grayscale.size[1]  # Width * Height
-        ratio_black = black_pixels / total_pixels
+        if draft_size is not None:
+            # JPEGs only: let the decoder produce a downscaled grayscale image directly. No-op for PNGs.
+            img.draft('L', draft_size)
+        ratio_black = black_ratio(img, threshold)
 
     return ratio_black > 0.95  # If 95% or more of the image is black, consider it as a black image
 
-def remove_black_images(folder_path):
+def _check_black(image_path):
+    # Module level so it can be pickled into the process pool. Timing is measured here and reported by the parent.
+    start = time.perf_counter()
+    black = is_black(image_path)
+    return image_path, black, time.perf_counter() - start, os.path.getsize(image_path)
+
+def remove_black_images(folder_path, manifest=None):
     i = 0
-    directory = [i for i in os.listdir(folder_path) if ".jpg" in i]
-    def remove_image(filename):
-        nonlocal i
-        image_path = os.path.join(folder_path, filename)
-        if is_black(image_path):
-            os.remove(image_path)
-            print(f"Removed black image: {filename}")
-            i += 1
-    with ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
-        list(tqdm(executor.map(remove_image, directory), total=len(directory), desc="Removing bad images", unit="pics"))
+    if manifest is not None:
+        names = manifest.pending("black", folder_path, ".jpg")
+    else:
+        names = [name for name in os.listdir(folder_path) if ".jpg" in name]
+    directory = [os.path.join(folder_path, name) for name in names]
+    results_by_name = []
+    chunksize = max(1, len(directory) // (multiprocessing.cpu_count() * 8))
+    with metrics.timer("process.black_stage"), ProcessPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
+        results = executor.map(_check_black, directory, chunksize=chunksize)
+        for image_path, black, seconds, size in tqdm(results, total=len(directory), desc="Removing bad images", unit="pics"):
+            metrics.observe("process.black_check", seconds)
+            metrics.add_bytes("process.black_read", size)
+            if black:
+                os.remove(image_path)
+                print(f"Removed black image: {os.path.basename(image_path)}")
+                i += 1
+            results_by_name.append((os.path.basename(image_path), "removed" if black else "kept"))
+    if manifest is not None:
+        manifest.record("black", folder_path, results_by_name)
+    metrics.count("process.black_checked", len(results_by_name))
+    metrics.count("process.black_removed", i)
     print(f"Removed {i} bad images.")
 
+def process_image(png_path, output_path, width, height, threshold=10):
+    """
+    Fused per-image stage: decode the PNG once, drop it if it is a black frame,
+    center-crop and write only the final JPG. Returns the written path, or None for black frames.
+    """
+    name = os.path.basename(png_path).split(".png")[0] + ".jpg"
+    with Image.open(png_path) as image:
+        cropped_image = crop_image(image, width, height, threshold)
+    if cropped_image is None:
+        return None
+    output_file_path = os.path.join(output_path, name)
+    cropped_image.save(output_file_path)
+    return output_file_path
+
+def crop_image(image, width, height, threshold=10):
+    """
+    RGB center crop of a decoded screenshot, or None if it is a black frame.
+    """
+    image.load()
+    # A 4x box-reduced copy is plenty to estimate the black ratio of a full screenshot.
+    if black_ratio(image.reduce(4), threshold) > 0.95:
+        return None
+    return center_crop(image, width, height).convert('RGB')
+
+def crop_screenshot(png_bytes, width, height, threshold=10):
+    """
+    Same as crop_image, for a screenshot held in memory (driver.get_screenshot_as_png()).
+    """
+    with Image.open(io.BytesIO(png_bytes)) as image:
+        return crop_image(image, width, height, threshold)
+
+def _process_image_star(args):
+    # Returns (written path or None, seconds, bytes read, bytes written) for the parent to report.
+    start = time.perf_counter()
+    result = process_image(*args)
+    seconds = time.perf_counter() - start
+    return result, seconds, os.path.getsize(args[0]), os.path.getsize(result) if result is not None else 0
+
+def process_folder(folder_path, output_path, width, height, chunksize=None, manifest=None):
+    """
+    Run process_image over every PNG in folder_path, writing crops into output_path.
+    Replaces convert_png_to_jpg -> remove_black_images -> resize with a single decode per image.
+    """
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    if manifest is not None:
+        image_names = manifest.pending("fused", folder_path, ".png")
+    else:
+        image_names = sorted(name for name in os.listdir(folder_path) if name.endswith(".png"))
+    tasks = [(os.path.join(folder_path, name), output_path, width, height) for name in image_names]
+    workers = multiprocessing.cpu_count()
+    if chunksize is None:
+        # A few chunks per worker keeps the pool balanced without one IPC round trip per image.
+        chunksize = max(1, len(tasks) // (workers * 8))
+
+    written = 0
+    processed = []
+    with metrics.timer("process.fused_stage"), ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(_process_image_star, tasks, chunksize=chunksize)
+        for name, (result, seconds, read, wrote) in tqdm(zip(image_names, results), total=len(tasks), desc="Processing images", unit="pics"):
+            metrics.observe("process.fused", seconds)
+            metrics.add_bytes("process.fused_read", read)
+            metrics.add_bytes("process.fused_written", wrote)
+            if result is not None:
+                written += 1
+            processed.append((name, result))
+    if manifest is not None:
+        manifest.record("fused", folder_path, processed)
+    metrics.count("process.fused_processed", len(tasks))
+    metrics.count("process.fused_black_skipped", len(tasks) - written)
+    print(f"Wrote {written} images, skipped {len(tasks) - written} bad images.")
+    return written
+
 def get_folder_size(folder_path):
     png_size = 0
     jpg_size = 0
@@ -138,6 +327,7 @@ def move_pngs(source_folder):
         os.makedirs(destination_folder)
 
     i = 0
+    start = time.perf_counter()
     for root, _, files in os.walk(source_folder):
         files = [f for f in files if f.endswith(".png")]
         for file in tqdm(files, desc="Moving PNGs out", unit="pngs"):
@@ -146,11 +336,26 @@ def move_pngs(source_folder):
             os.makedirs(destination_folder, exist_ok=True)
             shutil.move(source_file_path, destination_file_path)
             i += 1
+    metrics.observe("process.move_pngs_stage", time.perf_counter() - start)
+    metrics.count("process.pngs_moved", i)
     print(f"Moved {i} PNGs from {parent_folder} to {destination_folder}.")
 
 if __name__ == "__main__":
     """Only need to change the country name. Then hit run."""
     countries = ["testing"]
+    # Decode each PNG once and write only the cropped JPG. Set to False for the old three-pass flow.
+    fused = True
+    # Skip images an earlier run already handled (tracked in <country>/.manifest.jsonl).
+    incremental = True
+    # Delete near-duplicate crops (tracked in <country>WxH/.dedup.jsonl). Set to False to keep them.
+    dedup = True
+    # Cut several overlapping tiles (plus 2x-downscaled ones) per screenshot instead of one center crop.
+    # Runs the three-pass flow; tiles keep their screenshot's name as a prefix so splits stay leak-free.
+    tile = False
+    tile_levels = (1, 2)
+    # Per-stage timings, counts and bytes are written here (JSON + .prom) at the end of the run.
+    metrics_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "metrics",
+                                f"processing_{time.strftime('%m.%d.%Y_%H%M%S')}.json")
 
 
     username = getpass.getuser()
@@ -161,17 +366,31 @@ if __name__ == "__main__":
         path_to_images = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), country)
         path_to_resized_images = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), f"{country}{width}x{height}")
 
-        convert_png_to_jpg(path_to_images)
+        manifest = Manifest.for_folder(path_to_images) if incremental else None
+
+        if fused and not tile:
+            process_folder(path_to_images, path_to_resized_images, width, height, manifest=manifest)
+            move_pngs(path_to_images)
+            if dedup:
+                remove_duplicates(path_to_resized_images)
+            continue
+
+        convert_png_to_jpg(path_to_images, manifest=manifest)
         
-        t, p, j, np, nj = get_folder_size(path_to_images)
+        t, p, j, n_pngs, n_jpgs = get_folder_size(path_to_images)
         
         print(f"Folder size: {t} GB")
         print(f"Total size of PNGs: {p} GB")
         print(f"Total size of JPGs: {j} GB")
-        print(f"Total number of PNGs: {np}")
-        print(f"Total number of JPGs: {nj}")
+        print(f"Total number of PNGs: {n_pngs}")
+        print(f"Total number of JPGs: {n_jpgs}")
         
         move_pngs(path_to_images)
-        remove_black_images(path_to_images)
+        remove_black_images(path_to_images, manifest=manifest)
         
-        resize(path_to_images,path_to_resized_images, height, width)     
\ No newline at end of file
+        resize(path_to_images,path_to_resized_images, height, width, manifest=manifest, tile=tile, levels=tile_levels)
+        if dedup:
+            remove_duplicates(path_to_resized_images)
+
+    print(metrics.summary())
+    metrics.write_report(metrics_path)
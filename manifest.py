@@ -0,0 +1,78 @@
+import os, json
+
+"""
+Append-only JSONL manifest of which files each preprocessing stage has already handled.
+
+Every line records one (stage, filename) pair together with the size and mtime the file had
+when it was processed, plus whatever the stage produced. A file is only handed to a stage again
+if it is new, or its size/mtime changed since it was recorded. Later lines win, so the file never
+needs rewriting; call compact() now and then to drop superseded lines.
+"""
+class Manifest():
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn last line from an interrupted run; the file will simply be redone.
+                        continue
+                    self.entries[(record["stage"], record["name"])] = record
+
+    @classmethod
+    def for_folder(cls, folder_path):
+        return cls(os.path.join(folder_path, ".manifest.jsonl"))
+
+    """
+    Returns the names in folder_path ending with suffix that the stage has not yet seen in their current state.
+    """
+    def pending(self, stage, folder_path, suffix):
+        names = []
+        with os.scandir(folder_path) as it:
+            for entry in it:
+                if not entry.name.endswith(suffix) or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                record = self.entries.get((stage, entry.name))
+                if record is None or record["size"] != stat.st_size or record["mtime_ns"] != stat.st_mtime_ns:
+                    names.append(entry.name)
+        return sorted(names)
+
+    def output(self, stage, name):
+        record = self.entries.get((stage, name))
+        return None if record is None else record["output"]
+
+    """
+    Record what a stage produced for each input. results is an iterable of (name, output) pairs.
+    """
+    def record(self, stage, folder_path, results):
+        lines = []
+        for name, output in results:
+            input_path = os.path.join(folder_path, name)
+            if os.path.exists(input_path):
+                stat = os.stat(input_path)
+                size, mtime_ns = stat.st_size, stat.st_mtime_ns
+            else:
+                # Input removed by the stage itself (e.g. a deleted black frame).
+                size, mtime_ns = None, None
+            record = {"stage": stage, "name": name, "size": size, "mtime_ns": mtime_ns, "output": output}
+            self.entries[(stage, name)] = record
+            lines.append(json.dumps(record) + "\n")
+        if lines:
+            with open(self.path, "a") as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for record in self.entries.values():
+                f.write(json.dumps(record) + "\n")
+        os.replace(tmp_path, self.path)
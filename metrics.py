@@ -0,0 +1,191 @@
+import os, sys, json, time, bisect, threading, argparse, functools
+from contextlib import contextmanager
+
+"""
+Shared run metrics for the capture -> processing -> indexing -> training pipeline.
+
+Every stage reports into one process-wide registry:
+    metrics.count("process.black_removed")            counters (events, images)
+    metrics.add_bytes("process.read", n)              bytes read/written (stored as counters with a _bytes suffix)
+    metrics.observe("capture.panorama_wait", seconds) latency histograms
+    with metrics.timer("dataset.index"): ...           time a block into a histogram
+
+At the end of a run, write_report(path) writes path (JSON) and path with a .prom suffix (Prometheus
+text exposition format). Compare two JSON reports to find regressions:
+
+python metrics.py compare runs/before.json runs/after.json
+
+Stages that run in process pools measure in the worker and report the numbers back to the parent,
+since each process has its own registry.
+"""
+
+# Histogram bucket upper bounds in seconds, roughly x2.5 apart from 1 ms to 5 min.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 60.0, 150.0, 300.0)
+
+class Histogram():
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation (the max for the +Inf bucket).
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets + (self.max,), self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.sum, "mean": self.sum / self.count if self.count else 0.0,
+                "min": self.min if self.count else 0.0, "max": self.max,
+                "p50": self.quantile(0.5), "p90": self.quantile(0.9), "p99": self.quantile(0.99),
+                "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], self.counts))}
+
+class Metrics():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_bytes(self, name, n):
+        self.count(f"{name}_bytes", n)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        # Decorator form of timer.
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def reset(self):
+        with self.lock:
+            self.start = time.time()
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        with self.lock:
+            return {"start": self.start, "elapsed": time.time() - self.start, "pid": os.getpid(),
+                    "argv": sys.argv,
+                    "counters": dict(sorted(self.counters.items())),
+                    "histograms": {name: h.to_dict() for name, h in sorted(self.histograms.items())}}
+
+    def to_prometheus(self, prefix="ggai"):
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in snapshot["counters"].items():
+            metric = _prometheus_name(prefix, name) + "_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+        for name, h in snapshot["histograms"].items():
+            metric = _prometheus_name(prefix, name) + "_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, n in h["buckets"].items():
+                cumulative += n
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines += [f"{metric}_sum {h['sum']}", f"{metric}_count {h['count']}"]
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, path):
+        """
+        Write the JSON report to path and the Prometheus text to path with its suffix replaced by .prom.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+        with open(os.path.splitext(path)[0] + ".prom", "w") as f:
+            f.write(self.to_prometheus())
+        return path
+
+    def summary(self):
+        snapshot = self.snapshot()
+        lines = [f"{name:40s} {value}" for name, value in snapshot["counters"].items()]
+        for name, h in snapshot["histograms"].items():
+            lines.append(f"{name:40s} n={h['count']} total={h['sum']:.2f}s mean={h['mean'] * 1000:.1f}ms "
+                         f"p50<={h['p50'] * 1000:.1f}ms p99<={h['p99'] * 1000:.1f}ms")
+        return "\n".join(lines)
+
+def _prometheus_name(prefix, name):
+    return prefix + "_" + "".join(c if c.isalnum() else "_" for c in name)
+
+REGISTRY = Metrics()
+count = REGISTRY.count
+add_bytes = REGISTRY.add_bytes
+observe = REGISTRY.observe
+timer = REGISTRY.timer
+timed = REGISTRY.timed
+reset = REGISTRY.reset
+snapshot = REGISTRY.snapshot
+summary = REGISTRY.summary
+write_report = REGISTRY.write_report
+
+"""
+Side by side totals and means of two JSON reports, flagging histograms whose mean moved more than threshold.
+"""
+def compare(before_path, after_path, threshold=0.1):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    rows = []
+    for name in sorted(set(before["counters"]) | set(after["counters"])):
+        rows.append((name, before["counters"].get(name, 0), after["counters"].get(name, 0), ""))
+    for name in sorted(set(before["histograms"]) | set(after["histograms"])):
+        old = before["histograms"].get(name, {}).get("mean", 0.0)
+        new = after["histograms"].get(name, {}).get("mean", 0.0)
+        change = (new - old) / old if old else 0.0
+        flag = "slower" if change > threshold else "faster" if change < -threshold else ""
+        rows.append((f"{name} (mean ms)", round(old * 1000, 3), round(new * 1000, 3), f"{change:+.0%} {flag}".strip()))
+    for name, old, new, note in rows:
+        print(f"{name:50s} {old:>14} {new:>14}  {note}")
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two metrics reports written by metrics.write_report.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compare_parser = subparsers.add_parser("compare")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+    compare(args.before, args.after, args.threshold)
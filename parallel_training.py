@@ -0,0 +1,263 @@
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import os, time, argparse, threading
+
+from NN import NN, tanh, tanh_grad
+
+"""
+Data-parallel training for NN.NN on one multi-core machine.
+
+The parameters live in one shared-memory block that the parent's model and every worker map.
+For each mini-batch the parent gathers the rows into a shared batch buffer, every worker computes
+the summed gradients of its slice of the rows straight into its own slot of a shared gradient
+block, and the parent all-reduces the slots (summed in worker order, so runs are repeatable) into
+the weights and biases. Workers are pinned to one BLAS thread each so N workers use N cores.
+A watchdog thread aborts the barrier if a worker dies, so the parent raises instead of hanging.
+
+Initialisation is NN.init_weights (np.random.seed(0)) and shuffling uses a seeded generator, so
+a run is deterministic for a given worker count and matches single-process NN.fit up to float
+summation order.
+
+Workers are spawned, so custom activations must be registered in NN.ACTIVATIONS or be picklable.
+"""
+
+BLAS_THREAD_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+
+def _layout(arch):
+    # (shape, offset) of every weight matrix then every bias row in the flat parameter block.
+    shapes = [(arch[n], arch[n + 1]) for n in range(len(arch) - 1)] + [(1, arch[n + 1]) for n in range(len(arch) - 1)]
+    offsets = np.concatenate(([0], np.cumsum([a * b for a, b in shapes])))
+    return shapes, offsets
+
+def _views(buffer, arch, dtype, offset=0):
+    shapes, offsets = _layout(arch)
+    arrays = [np.ndarray(shape, dtype=dtype, buffer=buffer, offset=(offset + start) * dtype.itemsize)
+              for shape, start in zip(shapes, offsets)]
+    half = len(arch) - 1
+    return arrays[:half], arrays[half:]
+
+def _worker(rank, num_workers, config, names, barrier, control, losses):
+    arch, dtype = config["arch"], np.dtype(config["dtype"])
+    n_params = int(_layout(arch)[1][-1])
+    blocks = {key: shared_memory.SharedMemory(name=name) for key, name in names.items()}
+    model = X_batch = y_batch = None
+    try:
+        model = NN(arch, learning_rate=config["lr"], activation=config["activation"],
+                   activation_grad=config["activation_grad"], dtype=dtype, loss=config["loss"])
+        model.weights, model.biases = _views(blocks["params"].buf, arch, dtype)
+        model._allocate(config["batch_size"] // num_workers + 1)
+        # Gradients land directly in this worker's slot of the shared block.
+        model._weights_grad, model._biases_grad = _views(blocks["grads"].buf, arch, dtype, offset=rank * n_params)
+        X_batch = np.ndarray((config["batch_size"], arch[0]), dtype=dtype, buffer=blocks["X"].buf)
+        y_batch = np.ndarray((config["batch_size"],) + tuple(config["y_shape"]), dtype=config["y_dtype"], buffer=blocks["y"].buf)
+
+        while True:
+            barrier.wait()  # batch ready
+            b, stop = control[0], control[1]
+            if stop:
+                break
+            start, end = rank * b // num_workers, (rank + 1) * b // num_workers
+            if end > start:
+                losses[rank] = model.accumulate_grads(X_batch[start:end], y_batch[start:end])
+            else:
+                for grad in model._weights_grad + model._biases_grad:
+                    grad.fill(0)
+                losses[rank] = 0.0
+            barrier.wait()  # gradients ready
+    except threading.BrokenBarrierError:
+        pass  # the parent gave up on this run
+    finally:
+        del model, X_batch, y_batch
+        for block in blocks.values():
+            block.close()
+
+class DataParallelTrainer():
+    def __init__(self, model, num_workers=None, batch_size=64, threads_per_worker=1, timeout=None):
+        self.model = model
+        self.num_workers = num_workers or mp.cpu_count()
+        self.batch_size = batch_size
+        self.threads_per_worker = threads_per_worker
+        # Seconds the parent waits at a barrier before giving up on the workers (None waits as long as they live).
+        self.timeout = timeout
+        self.processes = []
+        self.blocks = {}
+        self.shared_params = False
+        self.grads = self.params = self.X_batch = self.y_batch = None
+        self.watchdog = None
+        self.stopping = threading.Event()
+
+    def _start(self, y_shape, y_dtype):
+        model, dtype = self.model, self.model.dtype
+        arch = model.arch
+        n_params = int(_layout(arch)[1][-1])
+        sizes = {
+            "params": n_params * dtype.itemsize,
+            "grads": self.num_workers * n_params * dtype.itemsize,
+            "X": self.batch_size * arch[0] * dtype.itemsize,
+            "y": self.batch_size * int(np.prod(y_shape)) * np.dtype(y_dtype).itemsize,
+        }
+        # Filled one by one so close() can release whatever a failed start managed to create.
+        self.blocks = {}
+        for key, size in sizes.items():
+            self.blocks[key] = shared_memory.SharedMemory(create=True, size=max(1, size))
+
+        # Move the model's parameters into shared memory; the model keeps working on the shared views.
+        weights, biases = _views(self.blocks["params"].buf, arch, dtype)
+        for dst, src in zip(weights + biases, model.weights + model.biases):
+            dst[...] = src
+        model.weights, model.biases = weights, biases
+        self.shared_params = True
+        self.grads = np.ndarray((self.num_workers, n_params), dtype=dtype, buffer=self.blocks["grads"].buf)
+        self.params = np.ndarray((n_params,), dtype=dtype, buffer=self.blocks["params"].buf)
+        self.X_batch = np.ndarray((self.batch_size, arch[0]), dtype=dtype, buffer=self.blocks["X"].buf)
+        self.y_batch = np.ndarray((self.batch_size,) + tuple(y_shape), dtype=y_dtype, buffer=self.blocks["y"].buf)
+
+        # Spawned (not forked) workers import numpy afresh, so the BLAS thread limit below takes effect.
+        ctx = mp.get_context("spawn")
+        self.barrier = ctx.Barrier(self.num_workers + 1)
+        self.control = ctx.Array("q", 2, lock=False)
+        self.losses = ctx.Array("d", self.num_workers, lock=False)
+        config = {"arch": arch, "dtype": dtype.str, "lr": model.lr, "loss": model.loss,
+                  # Named activations travel as their registry name; anything else has to pickle.
+                  "activation": model.activation_name or model.activation,
+                  "activation_grad": None if model.activation_name else model.activation_grad,
+                  "batch_size": self.batch_size, "y_shape": tuple(y_shape), "y_dtype": np.dtype(y_dtype).str}
+        names = {key: block.name for key, block in self.blocks.items()}
+        saved = {var: os.environ.get(var) for var in BLAS_THREAD_VARS}
+        os.environ.update({var: str(self.threads_per_worker) for var in BLAS_THREAD_VARS})
+        try:
+            for rank in range(self.num_workers):
+                process = ctx.Process(target=_worker, args=(rank, self.num_workers, config, names,
+                                                           self.barrier, self.control, self.losses), daemon=True)
+                process.start()
+                self.processes.append(process)
+        finally:
+            for var, value in saved.items():
+                if value is None:
+                    os.environ.pop(var, None)
+                else:
+                    os.environ[var] = value
+        self.stopping.clear()
+        self.watchdog = threading.Thread(target=self._watch, name="trainer-watchdog", daemon=True)
+        self.watchdog.start()
+
+    def _watch(self, poll=0.5):
+        # A dead worker never reaches the barrier; break it so everyone waiting there raises.
+        while not self.stopping.wait(poll):
+            if any(not process.is_alive() for process in self.processes):
+                self.barrier.abort()
+                return
+
+    def _wait(self):
+        try:
+            self.barrier.wait(self.timeout)
+        except threading.BrokenBarrierError:
+            dead = [rank for rank, process in enumerate(self.processes) if not process.is_alive()]
+            if dead:
+                raise RuntimeError(f"Training worker(s) {dead} died.") from None
+            raise RuntimeError(f"Training workers did not reach the barrier within {self.timeout} s.") from None
+
+    def close(self):
+        if self.processes:
+            # The watchdog is still running, so a worker dying now breaks this wait too.
+            if len(self.processes) == self.num_workers and not self.barrier.broken:
+                self.control[1] = 1
+                try:
+                    self.barrier.wait(self.timeout)
+                except threading.BrokenBarrierError:
+                    pass
+            # After a failure the survivors are released by the broken barrier; stragglers are killed.
+            self.barrier.abort()
+            for process in self.processes:
+                process.join(timeout=10)
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+            self.processes = []
+        self.stopping.set()
+        if self.watchdog is not None:
+            self.watchdog.join()
+            self.watchdog = None
+        if self.shared_params:
+            # Hand the model private copies before the shared block goes away.
+            self.model.weights = [w.copy() for w in self.model.weights]
+            self.model.biases = [b.copy() for b in self.model.biases]
+            self.shared_params = False
+        self.grads = self.params = self.X_batch = self.y_batch = None
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+    def step(self, b):
+        self.control[0] = b
+        self._wait()  # workers start
+        self._wait()  # workers done
+        # All-reduce: sum the worker slots in a fixed order, then one update of the shared parameters.
+        total = self.grads.sum(axis=0)
+        total *= self.model.lr / b
+        self.params -= total
+        return sum(self.losses) / b
+
+    def fit(self, X, y, epochs=1, shuffle=True, seed=0, verbose=True):
+        X = np.asarray(X)
+        y = np.asarray(y)
+        y = y.reshape(-1) if self.model.loss == "cross_entropy" else (y.reshape(-1, 1) if y.ndim == 1 else y)
+        y_dtype = np.intp if self.model.loss == "cross_entropy" else self.model.dtype
+        rng = np.random.default_rng(seed)
+        history = []
+        try:
+            self._start(y.shape[1:], y_dtype)
+            for epoch in range(epochs):
+                start = time.perf_counter()
+                total, seen = 0.0, 0
+                order = rng.permutation(len(X)) if shuffle else np.arange(len(X))
+                for i in range(0, len(X), self.batch_size):
+                    idx = np.sort(order[i:i + self.batch_size])
+                    b = len(idx)
+                    self.X_batch[:b] = X[idx]
+                    self.y_batch[:b] = y[idx]
+                    total += self.step(b) * b
+                    seen += b
+                history.append(total / seen)
+                self.samples_per_second = seen / (time.perf_counter() - start)
+                if verbose:
+                    print(f"Epoch {epoch+1}/{epochs} - Loss: {history[-1]:.6f} "
+                          f"({self.samples_per_second:.0f} samples/s, {self.num_workers} workers)")
+        finally:
+            self.close()
+        return history
+
+"""
+Train the same model with 1..max_workers workers and report throughput and scaling efficiency
+(throughput with N workers / (N * throughput with 1 worker)).
+"""
+def scaling_report(arch, X, y, max_workers=None, batch_size=256, epochs=1, **model_kwargs):
+    max_workers = max_workers or mp.cpu_count()
+    counts = sorted({1, max_workers} | {2 ** k for k in range(1, max_workers.bit_length()) if 2 ** k <= max_workers})
+    results = []
+    for n in counts:
+        trainer = DataParallelTrainer(NN(arch, **model_kwargs), num_workers=n, batch_size=batch_size)
+        trainer.fit(X, y, epochs=epochs, verbose=False)
+        rate = trainer.samples_per_second
+        base = results[0]["samples_per_second"] if results else rate
+        results.append({"workers": n, "samples_per_second": rate, "speedup": rate / base, "efficiency": rate / (n * base)})
+        print(f"{n:3d} workers: {rate:10.0f} samples/s  speedup {rate / base:5.2f}x  efficiency {rate / (n * base):6.1%}")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scaling report for data-parallel NN training on random data.")
+    parser.add_argument("--samples", type=int, default=8192)
+    parser.add_argument("--features", type=int, default=224 * 224)
+    parser.add_argument("--hidden", type=int, default=128)
+    parser.add_argument("--classes", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    X = rng.random((args.samples, args.features), dtype=np.float32)
+    y = rng.integers(0, args.classes, args.samples)
+    scaling_report([args.features, args.hidden, args.classes], X, y, args.workers, args.batch_size,
+                   learning_rate=1e-3, activation=tanh, activation_grad=tanh_grad, dtype=np.float32, loss="cross_entropy")
@@ -0,0 +1,267 @@
+from PIL import Image
+import numpy as np
+import io, os, json, time, queue, threading, argparse, urllib.request, urllib.parse
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from image_processing import center_crop
+
+"""
+Local inference server for the country classifier.
+
+python serve.py serve --cnn model.pt --classes ../classes_224.json --port 8000
+python serve.py serve --nn model.nn --classes ../classes_224.json
+python serve.py load --url http://localhost:8000 --images ../taiwan224x224 --concurrency 16 --requests 2000
+
+POST /predict?k=3 with the raw bytes of a screenshot (any size, PNG or JPG) returns
+{"top_k": [{"class": ..., "probability": ...}, ...]}. GET /stats returns latency percentiles and throughput.
+
+Requests are preprocessed on the handler threads (center crop as in image_processing.resize, then the
+notebook's tf for the CNN) and handed to a single batching thread, which waits at most max_latency
+seconds after the first request for up to max_batch requests and runs them through the model together.
+--nn takes models trained on flattened pixels only; heads saved by embeddings.py are refused at load.
+"""
+
+class CNNPredictor():
+    def __init__(self, path, num_classes, size=224, threads=None):
+        import torch
+        from train import CNN, tf
+        self.torch = torch
+        self.tf = tf
+        self.size = size
+        if threads:
+            torch.set_num_threads(threads)
+        self.model = CNN(num_classes=num_classes)
+        self.model.load_state_dict(torch.load(path, map_location="cpu"))
+        self.model.eval()
+
+    def preprocess(self, image):
+        image = center_crop(image, self.size, self.size).convert('RGB')
+        tensor = self.torch.from_numpy(np.asarray(image).transpose(2, 0, 1).copy())
+        return self.tf(tensor)
+
+    def predict_proba(self, inputs):
+        with self.torch.no_grad():
+            # CNN ends in a Softmax, so its outputs already are probabilities.
+            return self.model(self.torch.stack(inputs)).numpy()
+
+class NNPredictor():
+    def __init__(self, path, size=224):
+        from NN import NN
+        self.model = NN.load(path)
+        self.size = size
+        # Heads trained by embeddings.py take backbone features, which this server does not compute.
+        if self.model.input_kind != "pixels":
+            raise ValueError(f"{path} takes {self.model.input_kind} inputs; NNPredictor only feeds flattened pixels.")
+        if self.model.arch[0] != 3 * size * size:
+            raise ValueError(f"{path} takes {self.model.arch[0]} inputs, not {size}x{size} RGB pixels.")
+
+    def preprocess(self, image):
+        image = center_crop(image, self.size, self.size).convert('RGB')
+        # Flattened pixels scaled to [0, 1], the input layout NN models are trained on.
+        return np.asarray(image, dtype=self.model.dtype).reshape(-1) / 255
+
+    def predict_proba(self, inputs):
+        return self.model.predict_proba(np.stack(inputs), batch_size=len(inputs))
+
+class LatencyStats():
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.window = window
+        self.batch_sizes = []
+        self.completed = 0
+        self.start = time.monotonic()
+
+    def record(self, latencies, batch_size):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.latencies = self.latencies[-self.window:]
+            self.batch_sizes.append(batch_size)
+            self.batch_sizes = self.batch_sizes[-self.window:]
+            self.completed += len(latencies)
+
+    def summary(self):
+        with self.lock:
+            latencies = np.asarray(self.latencies) if self.latencies else np.zeros(1)
+            elapsed = time.monotonic() - self.start
+            return {
+                "requests": self.completed,
+                "throughput": self.completed / elapsed if elapsed else 0.0,
+                "latency_p50_ms": float(np.percentile(latencies, 50) * 1000),
+                "latency_p99_ms": float(np.percentile(latencies, 99) * 1000),
+                "mean_batch_size": float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+            }
+
+class DynamicBatcher():
+    def __init__(self, predictor, max_batch=32, max_latency=0.01):
+        self.predictor = predictor
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self.stats = LatencyStats()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, model_input):
+        future = Future()
+        self.queue.put((model_input, future, time.monotonic()))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                probabilities = self.predictor.predict_proba([item[0] for item in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            done = time.monotonic()
+            for (_, future, _), row in zip(batch, probabilities):
+                future.set_result(row)
+            self.stats.record([done - item[2] for item in batch], len(batch))
+
+def make_handler(batcher, class_names):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._reply(200, batcher.stats.summary())
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            url = urllib.parse.urlparse(self.path)
+            if url.path != "/predict":
+                self._reply(404, {"error": "not found"})
+                return
+            try:
+                k = int(urllib.parse.parse_qs(url.query).get("k", ["3"])[0])
+                if k < 1:
+                    raise ValueError(k)
+            except ValueError:
+                self._reply(400, {"error": "k must be a positive integer"})
+                return
+            try:
+                data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with Image.open(io.BytesIO(data)) as image:
+                    model_input = batcher.predictor.preprocess(image)
+            except Exception as e:
+                self._reply(400, {"error": f"could not read image: {e}"})
+                return
+            try:
+                probabilities = batcher.submit(model_input).result()
+            except Exception as e:
+                self._reply(500, {"error": f"prediction failed: {e}"})
+                return
+            top = np.argsort(probabilities)[::-1][:k]
+            self._reply(200, {"top_k": [{"class": class_names.get(int(i), int(i)), "probability": float(probabilities[i])}
+                                        for i in top]})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def load_class_names(path):
+    # classes_<dim>.json from dataset.py maps folder name -> id.
+    if path is None:
+        return {}
+    with open(path) as f:
+        return {class_id: name for name, class_id in json.load(f).items()}
+
+def serve(predictor, host="127.0.0.1", port=8000, class_names=None, max_batch=32, max_latency=0.01):
+    batcher = DynamicBatcher(predictor, max_batch, max_latency)
+    server = ThreadingHTTPServer((host, port), make_handler(batcher, class_names or {}))
+    print(f"Serving on http://{host}:{port} (max batch {max_batch}, window {max_latency * 1000:.0f} ms)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(batcher.stats.summary(), indent=2))
+
+"""
+Load generator: POST images from a folder with `concurrency` client threads and report latency and throughput.
+"""
+def load_test(url, image_folder, concurrency=16, requests=1000, k=3):
+    names = sorted(name for name in os.listdir(image_folder) if name.endswith((".jpg", ".png")))
+    if not names:
+        raise ValueError(f"No images found in {image_folder}")
+    payloads = []
+    for name in names[:min(len(names), 256)]:
+        with open(os.path.join(image_folder, name), "rb") as f:
+            payloads.append(f.read())
+
+    def one(i):
+        start = time.monotonic()
+        request = urllib.request.Request(f"{url}/predict?k={k}", data=payloads[i % len(payloads)], method="POST")
+        with urllib.request.urlopen(request) as response:
+            response.read()
+        return time.monotonic() - start
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = np.asarray(list(executor.map(one, range(requests))))
+    elapsed = time.monotonic() - start
+    result = {"requests": requests, "concurrency": concurrency, "throughput": requests / elapsed,
+              "latency_p50_ms": float(np.percentile(latencies, 50) * 1000),
+              "latency_p99_ms": float(np.percentile(latencies, 99) * 1000)}
+    print(json.dumps(result, indent=2))
+    with urllib.request.urlopen(f"{url}/stats") as response:
+        print("Server:", response.read().decode())
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch inference server for the country classifier.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    server_parser = subparsers.add_parser("serve")
+    model = server_parser.add_mutually_exclusive_group(required=True)
+    model.add_argument("--cnn", help="state_dict saved by train.py --save")
+    model.add_argument("--nn", help="model saved by NN.save")
+    server_parser.add_argument("--classes", default=None, help="classes_<dim>.json written by dataset.py")
+    server_parser.add_argument("--num-classes", type=int, default=None)
+    server_parser.add_argument("--host", default="127.0.0.1")
+    server_parser.add_argument("--port", type=int, default=8000)
+    server_parser.add_argument("--max-batch", type=int, default=32)
+    server_parser.add_argument("--max-latency-ms", type=float, default=10)
+    server_parser.add_argument("--threads", type=int, default=None)
+
+    load_parser = subparsers.add_parser("load")
+    load_parser.add_argument("--url", default="http://127.0.0.1:8000")
+    load_parser.add_argument("--images", required=True)
+    load_parser.add_argument("--concurrency", type=int, default=16)
+    load_parser.add_argument("--requests", type=int, default=1000)
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        class_names = load_class_names(args.classes)
+        if args.cnn:
+            num_classes = args.num_classes or len(class_names)
+            if not num_classes:
+                parser.error("--num-classes or --classes is required with --cnn")
+            predictor = CNNPredictor(args.cnn, num_classes, threads=args.threads)
+        else:
+            predictor = NNPredictor(args.nn)
+        serve(predictor, args.host, args.port, class_names, args.max_batch, args.max_latency_ms / 1000)
+    else:
+        load_test(args.url, args.images, args.concurrency, args.requests)
@@ -0,0 +1,198 @@
+from PIL import Image
+from tqdm import tqdm
+import numpy as np
+import pandas as pd
+import os, json, argparse, multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from torch.utils.data import Dataset
+
+"""
+Packed training shards.
+
+Instead of one JPG per sample, the preprocessed crops are decoded once and stored as large uint8
+.npy arrays of shape (N, 3, H, W) (the layout torchvision's read_image returns), with the labels
+alongside. ShardedCountriesDataset memory-maps them, so reading a sample is a page-cache slice
+instead of a file open plus a JPEG decode.
+
+shard_dir/
+├── index.json
+├── images_00000.npy
+├── labels_00000.npy
+└── ...
+"""
+
+def _load_chw(path):
+    with Image.open(path) as image:
+        return np.asarray(image.convert('RGB')).transpose(2, 0, 1)
+
+def write_shards(df, shard_dir, shard_size=4096):
+    """
+    Pack the images listed in df (columns: images, class, as written by dataset.py) into shard_dir.
+    All images must share the same size.
+    """
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    paths = df.iloc[:, 0].tolist()
+    labels = df.iloc[:, 1].to_numpy(dtype=np.int64)
+    if not paths:
+        raise ValueError("No images to pack.")
+    channels, height, width = _load_chw(paths[0]).shape
+
+    shards = []
+    with ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
+        for shard_id, start in enumerate(tqdm(range(0, len(paths), shard_size), desc="Writing shards", unit="shards")):
+            chunk = paths[start:start + shard_size]
+            images_name = f"images_{shard_id:05d}.npy"
+            labels_name = f"labels_{shard_id:05d}.npy"
+            # Write straight into the memory-mapped file so a shard never has to fit in RAM twice.
+            images = np.lib.format.open_memmap(os.path.join(shard_dir, images_name), mode="w+",
+                                               dtype=np.uint8, shape=(len(chunk), channels, height, width))
+            for i, image in enumerate(executor.map(_load_chw, chunk)):
+                if image.shape != (channels, height, width):
+                    raise ValueError(f"{chunk[i]} has shape {image.shape}, expected {(channels, height, width)}")
+                images[i] = image
+            images.flush()
+            del images
+            np.save(os.path.join(shard_dir, labels_name), labels[start:start + shard_size])
+            shards.append({"images": images_name, "labels": labels_name, "count": len(chunk)})
+
+    index = {"shape": [channels, height, width], "count": len(paths), "shards": shards, "paths": paths}
+    with open(os.path.join(shard_dir, "index.json"), "w") as f:
+        json.dump(index, f)
+    return index
+
+class ShardedCountriesDataset(Dataset):
+    """
+    CustomCountriesDataset-style dataset that reads from write_shards output.
+    Samples come back as raw uint8 (3, H, W) tensors unless a transform is given; pass transform=train.tf
+    to get what the notebook's dataset returns. (train imports this module, so tf cannot be the default.)
+    Pass indices to use a subset (e.g. a train/test split) of the packed samples.
+    """
+    def __init__(self, shard_dir, indices=None, transform=None, target_transform=None):
+        self.shard_dir = shard_dir
+        self.transform = transform
+        self.target_transform = target_transform
+        with open(os.path.join(shard_dir, "index.json")) as f:
+            self.index = json.load(f)
+        counts = [shard["count"] for shard in self.index["shards"]]
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.indices = np.arange(self.index["count"]) if indices is None else np.asarray(indices)
+        # Labels are tiny; keep them all in memory.
+        self.labels = np.concatenate([np.load(os.path.join(shard_dir, shard["labels"])) for shard in self.index["shards"]])
+        # Opened lazily so each DataLoader worker maps the files itself instead of receiving pickled copies.
+        self._images = None
+
+    def __len__(self):
+        return len(self.indices)
+
+    def _open(self):
+        # Copy-on-write mapping: writable as far as torch is concerned, but never written back to disk.
+        self._images = [np.load(os.path.join(self.shard_dir, shard["images"]), mmap_mode="c")
+                        for shard in self.index["shards"]]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+    def __getitem__(self, idx):
+        if self._images is None:
+            self._open()
+        sample = self.indices[idx]
+        shard = np.searchsorted(self.offsets, sample, side="right") - 1
+        image = torch.from_numpy(self._images[shard][sample - self.offsets[shard]])
+        label = int(self.labels[sample])
+        if self.transform:
+            image = self.transform(image)
+        if self.target_transform:
+            label = self.target_transform(label)
+        return image, label
+
+"""
+Pre-decoded, pre-padded tensor cache for the notebook/train.py dataset.
+
+Each image is decoded once and stored padded (zeros, like transforms.Pad) as uint8 in one
+(N, 3, H + 2 * pad, W + 2 * pad) memory-mapped array, in the row order of the dataset CSV, with the
+labels in a NumPy array. Normalization is left to train.BatchNormalize on whole collated batches,
+so after the first build an epoch costs no decoding at all.
+
+cache_dir/
+├── cache.json     (paths, [size, mtime_ns] per path, shape, pad)
+├── images.npy
+└── labels.npy
+"""
+def build_tensor_cache(df, cache_dir, pad=1):
+    paths = df.iloc[:, 0].tolist()
+    labels = df.iloc[:, 1].to_numpy(dtype=np.int64)
+    # An image rewritten in place (e.g. re-cropped) keeps its path; size and mtime catch that.
+    files = [[stat.st_size, stat.st_mtime_ns] for stat in map(os.stat, paths)]
+    meta_path = os.path.join(cache_dir, "cache.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta["paths"] == paths and meta.get("files") == files and meta["pad"] == pad \
+                and np.array_equal(np.load(os.path.join(cache_dir, "labels.npy")), labels):
+            return meta
+        print(f"Dataset changed, rebuilding {cache_dir}")
+    if not paths:
+        raise ValueError("No images to cache.")
+    os.makedirs(cache_dir, exist_ok=True)
+    # Invalidate the old cache before overwriting it, so an interrupted rebuild is never taken as valid.
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    channels, height, width = _load_chw(paths[0]).shape
+    shape = (len(paths), channels, height + 2 * pad, width + 2 * pad)
+    images = np.lib.format.open_memmap(os.path.join(cache_dir, "images.npy"), mode="w+", dtype=np.uint8, shape=shape)
+    # open_memmap does not guarantee zeroed pages on every platform; clear the border explicitly.
+    if pad:
+        images[:, :, :pad, :] = 0
+        images[:, :, -pad:, :] = 0
+        images[:, :, :, :pad] = 0
+        images[:, :, :, -pad:] = 0
+    with ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
+        for i, image in enumerate(tqdm(executor.map(_load_chw, paths), total=len(paths), desc="Caching tensors", unit="pics")):
+            images[i, :, pad:pad + height, pad:pad + width] = image
+    images.flush()
+    del images
+    np.save(os.path.join(cache_dir, "labels.npy"), labels)
+    meta = {"paths": paths, "files": files, "shape": list(shape), "pad": pad}
+    # Written last: a cache without cache.json is treated as missing and rebuilt.
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+    return meta
+
+class CachedCountriesDataset(Dataset):
+    """
+    Reads uint8 (3, H+2, W+2) tensors and labels from build_tensor_cache output.
+    indices selects the rows (e.g. one side of a train/test split) of the cached CSV.
+    """
+    def __init__(self, cache_dir, indices=None):
+        self.cache_dir = cache_dir
+        self.labels = np.load(os.path.join(cache_dir, "labels.npy"))
+        self.indices = np.arange(len(self.labels)) if indices is None else np.asarray(indices)
+        self._images = None
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+    def __getitem__(self, idx):
+        if self._images is None:
+            self._images = np.load(os.path.join(self.cache_dir, "images.npy"), mmap_mode="c")
+        row = self.indices[idx]
+        return torch.from_numpy(self._images[row]), int(self.labels[row])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack a dataset CSV into memory-mappable shards.")
+    parser.add_argument("csv", help="CSV written by dataset.py, e.g. ../output_224.csv")
+    parser.add_argument("shard_dir")
+    parser.add_argument("--shard-size", type=int, default=4096)
+    args = parser.parse_args()
+
+    write_shards(pd.read_csv(args.csv), args.shard_dir, args.shard_size)
@@ -0,0 +1,147 @@
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+"""
+A stand-in for the GeoGuessr pages Browser drives, served from a local HTTP server.
+
+Every URL returns the same page; a small script renders the state for the current path from
+localStorage, building each element at the exact XPath (or with the class name) image_capture.py
+looks for. Pass the server URL as both home_link and game_link.
+
+/maps/<country>/play   cookie banner, login link and form until logged in, then the game settings
+                       and the start button. Starting a game moves to /game/<id>.
+/game/<id>             HUD, a non-black canvas as the panorama, the guess map, the guess button and
+                       the round result; SPACE advances rounds, and after round 5 starts a new game.
+"""
+
+COOKIE_BUTTON = "/html/body/div[2]/div[2]/div/div/div[2]/div/div/button"
+LOGIN_LINK = "/html/body/div[1]/div/div[2]/div[1]/div[2]/header/div[2]/div[2]/a"
+USERNAME = "/html/body/div[1]/div/div[2]/div[1]/main/div/div/form/div/div[1]/div[2]/input"
+PASSWORD = "/html/body/div[1]/div/div[2]/div[1]/main/div/div/form/div/div[2]/div[2]/input"
+SUBMIT = "/html/body/div[1]/div/div[2]/div[1]/main/div/div/form/div/div[3]/div[1]/div/button"
+START = "/html/body/div[1]/div[2]/div[2]/div[1]/main/div/div/div/div/div[3]/div/div/button"
+MAP = "/html/body/div[1]/div[2]/div[2]/main/div/div/div[4]/div/div[3]/div/div/div/div[3]/div[1]/div[2]"
+PLAY_AGAIN = "/html/body/div[1]/div[2]/div[2]/main/div[2]/div/div[2]/div/div[2]/div[3]/div/div/button"
+
+PAGE = """<!doctype html>
+<html><head><title>Stub GeoGuessr</title>
+<style>
+  button, input, a, section div { display: inline-block; min-width: 60px; min-height: 20px; margin: 2px; }
+  canvas { display: block; }
+</style>
+<script>
+const S = localStorage;
+
+// Create (or find) the element at an absolute /html/body/... XPath, padding missing siblings.
+function ensure(xpath) {
+  let node = document.body;
+  for (const step of xpath.split("/").filter(Boolean).slice(2)) {
+    const [, name, index] = step.match(/^(\\w+)(?:\\[(\\d+)\\])?$/);
+    const matches = Array.from(node.children).filter(c => c.tagName.toLowerCase() === name);
+    while (matches.length < Number(index || 1)) {
+      matches.push(node.appendChild(document.createElement(name)));
+    }
+    node = matches[Number(index || 1) - 1];
+  }
+  return node;
+}
+
+function leaf(xpath, text, onclick) {
+  const el = ensure(xpath);
+  if (el.tagName !== "INPUT") el.textContent = text;
+  if (onclick) el.onclick = onclick;
+  return el;
+}
+
+// Class-located elements go into a <section>, so they never shift the div indices the XPaths rely on.
+function classed(className, text) {
+  let section = document.querySelector("section");
+  if (!section) section = document.body.appendChild(document.createElement("section"));
+  const el = section.appendChild(document.createElement("div"));
+  el.className = className;
+  el.textContent = text;
+  return el;
+}
+
+function newGame() {
+  history.pushState({}, "", "/game/" + Date.now());
+  S.round = 1;
+  S.phase = "view";
+  render();
+}
+
+function render() {
+  document.body.innerHTML = "";
+  const path = location.pathname;
+  if (!S.cookies) leaf("%(COOKIE_BUTTON)s", "Accept", () => { S.cookies = 1; render(); });
+  if (path.endsWith("/play")) {
+    if (!S.loggedIn) {
+      leaf("%(LOGIN_LINK)s", "Log in", () => { S.form = 1; render(); });
+      if (S.form) {
+        leaf("%(USERNAME)s");
+        leaf("%(PASSWORD)s");
+        leaf("%(SUBMIT)s", "Submit", () => { S.loggedIn = 1; S.form = ""; render(); });
+      }
+      return;
+    }
+    classed("game-options_optionGroup__qNKx1", "NMPZ");
+    leaf("%(START)s", "Start game", newGame);
+  } else if (path.startsWith("/game/")) {
+    const round = Number(S.round);
+    const status = classed("game_status__q_b7N", "");
+    const number = status.appendChild(document.createElement("span"));
+    number.setAttribute("data-qa", "round-number");
+    number.textContent = "Round " + round + " / 5";
+    classed("game_controls___pIfC", "controls");
+    classed("game_topHud__tAKJD", "hud");
+    classed("game_guessMap__MTlQ_", "guess map");
+    const canvas = document.body.appendChild(document.createElement("canvas"));
+    canvas.width = 400;
+    canvas.height = 200;
+    const ctx = canvas.getContext("2d");
+    for (let i = 0; i < 8; i++) {
+      ctx.fillStyle = "hsl(" + (i * 45 + round * 10) + ", 60%%, 50%%)";
+      ctx.fillRect(i * 50, 0, 50, 200);
+    }
+    leaf("%(MAP)s", "map", () => { S.phase = "guessed"; render(); });
+    if (S.phase === "guessed") classed("button_variantPrimary__xc8Hp", "Guess");
+    if (S.phase === "result") {
+      classed("round-result_wrapper__V1VCe", "Result");
+      if (round >= 5) leaf("%(PLAY_AGAIN)s", "Play again");
+    }
+  }
+}
+
+document.addEventListener("keydown", e => {
+  if (e.key !== " ") return;
+  if (S.phase === "guessed") { S.phase = "result"; render(); }
+  else if (S.phase === "result") {
+    if (Number(S.round) >= 5) { newGame(); }
+    else { S.round = Number(S.round) + 1; S.phase = "view"; render(); }
+  }
+});
+document.addEventListener("DOMContentLoaded", render);
+</script>
+</head><body></body></html>
+""" % {"COOKIE_BUTTON": COOKIE_BUTTON, "LOGIN_LINK": LOGIN_LINK, "USERNAME": USERNAME, "PASSWORD": PASSWORD,
+       "SUBMIT": SUBMIT, "START": START, "MAP": MAP, "PLAY_AGAIN": PLAY_AGAIN}
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = PAGE.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+"""
+Start the stub on a free port in a daemon thread. Returns (server, base_url); call server.shutdown() when done.
+"""
+def start_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
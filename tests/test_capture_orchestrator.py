@@ -0,0 +1,78 @@
+import os, glob, shutil
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("selenium")
+import capture_orchestrator
+from capture_orchestrator import CaptureOrchestrator
+from image_capture import CaptureSession
+
+from stub_geoguessr import start_server
+
+requires_chrome = pytest.mark.skipif(
+    not any(shutil.which(name) for name in ("chromedriver", "google-chrome", "chromium", "chromium-browser")),
+    reason="Chrome is not installed")
+
+@pytest.fixture
+def stub_url():
+    server, url = start_server()
+    yield url
+    server.shutdown()
+
+def pngs(save_path, country):
+    return glob.glob(os.path.join(save_path, country, "*.png"))
+
+@requires_chrome
+def test_orchestrator_against_stub(tmp_path, stub_url):
+    orchestrator = CaptureOrchestrator("user", "pass", str(tmp_path), ["testland"], num_workers=2, total_images=10,
+                                       batch_size=5, home_link=stub_url, game_link=stub_url)
+    captured = orchestrator.run()
+    assert captured >= 10
+    assert len(pngs(str(tmp_path), "testland")) == captured
+
+@requires_chrome
+def test_session_plays_every_batch(tmp_path, stub_url):
+    session = CaptureSession("user", "pass", str(tmp_path), str(tmp_path / "cookies.json"), backoff=0,
+                             home_link=stub_url, game_link=stub_url, headless=True)
+    try:
+        session.run("testland", 5, show_progress=False)
+        session.run("testland", 5, show_progress=False)
+    finally:
+        session.close()
+    assert len(pngs(str(tmp_path), "testland")) == 10
+    assert session.restarts == 0
+
+"""
+Fails every third batch: the worker must keep going as long as failures are not consecutive.
+calls records (login, failed) for every start_game.
+"""
+class FlakyBrowser():
+    def __init__(self, orchestrator, calls):
+        self.orchestrator = orchestrator
+        self.calls = calls
+
+    def start_game(self, country, num_images, show_progress=True, login=True):
+        failed = len(self.calls) % 3 == 0
+        self.calls.append((login, failed))
+        if failed:
+            raise RuntimeError("Chrome went away")
+        for _ in range(num_images):
+            self.orchestrator.before_round()
+            self.orchestrator.after_round()
+
+    def quit(self):
+        pass
+
+def test_worker_restarts_count_failures_in_a_row(tmp_path, monkeypatch):
+    monkeypatch.setattr(capture_orchestrator.time, "sleep", lambda seconds: None)
+    calls = []
+    orchestrator = CaptureOrchestrator("user", "pass", str(tmp_path), ["testland"], num_workers=1, total_images=20,
+                                       batch_size=5, max_restarts=2)
+    orchestrator.make_browser = lambda: FlakyBrowser(orchestrator, calls)
+    assert orchestrator.run() == 20
+    # Calls 1 and 4 fail; four good batches of 5 in between. Never two failures in a row.
+    assert [failed for _, failed in calls] == [True, False, False, True, False, False]
+    assert orchestrator.restarts == [2]
+    # A call logs in exactly when it is the first on a new browser: the first call, and any after a failure.
+    assert calls[0][0]
+    assert all(calls[i][0] == calls[i - 1][1] for i in range(1, len(calls)))
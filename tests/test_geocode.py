@@ -0,0 +1,85 @@
+import json, time, asyncio, threading, urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+
+pytest.importorskip("pandas")
+pytest.importorskip("aiohttp")
+from geocode import ReverseGeocoder, grid_cell, region_label
+
+"""
+A Nominatim stand-in: GET /reverse answers after a short delay with the queried point as the state,
+counting requests per point and the most requests it ever had in flight at once.
+"""
+class StubNominatim(ThreadingHTTPServer):
+    def __init__(self, delay=0.05):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.inflight = 0
+        self.max_inflight = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        server = self.server
+        with server.lock:
+            server.inflight += 1
+            server.max_inflight = max(server.max_inflight, server.inflight)
+        try:
+            time.sleep(server.delay)
+            point = (float(query["lat"][0]), float(query["lon"][0]))
+            with server.lock:
+                server.counts[point] = server.counts.get(point, 0) + 1
+            body = json.dumps({"address": {"state": f"{point[0]:.3f},{point[1]:.3f}"}}).encode()
+        finally:
+            with server.lock:
+                server.inflight -= 1
+        self.send_response(200 if url.path == "/reverse" else 404)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def nominatim():
+    server = StubNominatim()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def geocode(url, cache_path, coords, max_concurrency):
+    async def run():
+        async with ReverseGeocoder(url, str(cache_path), max_concurrency=max_concurrency) as geocoder:
+            return await geocoder.reverse_many(coords), geocoder.stats()
+    return asyncio.run(run())
+
+def test_each_cell_fetched_once_then_cached(tmp_path, nominatim):
+    # 16 cells, each hit by two nearby points, in shuffled order.
+    points = [(25.0 + 0.01 * i + 0.002, 121.5 + 0.003) for i in range(16)]
+    coords = points + [(lat + 0.004, lon + 0.004) for lat, lon in reversed(points)]
+    cells = {grid_cell(lat, lon) for lat, lon in coords}
+    assert len(cells) == 16
+
+    results, stats = geocode(nominatim.url, tmp_path / "geocode.sqlite", coords, max_concurrency=3)
+    assert sorted(nominatim.counts) == sorted(cells)
+    assert set(nominatim.counts.values()) == {1}
+    assert stats["requests"] == 16 and stats["cached_cells"] == 16
+    for (lat, lon), result in zip(coords, results):
+        cell = grid_cell(lat, lon)
+        assert region_label(result) == f"{cell[0]:.3f},{cell[1]:.3f}"
+    assert 1 < nominatim.max_inflight <= 3
+
+    again, stats = geocode(nominatim.url, tmp_path / "geocode.sqlite", coords, max_concurrency=3)
+    assert again == results
+    assert stats["cache_hits"] == 16 and stats["cache_misses"] == 0 and stats["requests"] == 0
+    assert set(nominatim.counts.values()) == {1}
@@ -0,0 +1,302 @@
+import torch, time, argparse
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import train_test_split
+from torchvision.transforms import Compose
+from torchvision import transforms
+from torchvision.io import read_image
+from torch.utils.data import Dataset, DataLoader
+
+from shards import build_tensor_cache, CachedCountriesDataset
+from dataset import group_split
+import metrics
+
+import torch.nn as nn
+from torch import optim
+from tqdm import tqdm
+
+"""
+CPU training engine for the country classifier (the model and loop from resnet.ipynb).
+
+Usage:
+python train.py --csv ../output_224.csv --epochs 5 --num-workers 8 --threads 16 --channels-last
+
+Every epoch prints how the time split between waiting for data, the forward pass and the
+backward pass (including the optimizer step). If "data" dominates, raise --num-workers;
+if it is near zero, the DataLoader keeps up and compute is the limit.
+"""
+
+tf = Compose([
+     transforms.ConvertImageDtype(torch.float),
+     transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+     transforms.Pad(1)
+ ])
+
+class CustomCountriesDataset(Dataset):
+    def __init__(self, df, transform=tf, target_transform=None):
+        self.df = df
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.df)
+
+    def __getitem__(self, idx):
+        image = read_image(self.df.iloc[idx, 0])
+        label = self.df.iloc[idx, 1]
+        if self.transform:
+            image = self.transform(image)
+        return image, label
+
+class CNN(nn.Module):
+    def __init__(self,num_classes, in_channels=3):
+        super(CNN, self).__init__()
+        self.convolutions = nn.Sequential(
+            nn.Conv2d(3, 64, kernel_size=3, padding=1),
+            nn.BatchNorm2d(64),
+            nn.ReLU(inplace=True),
+            nn.MaxPool2d(kernel_size=2, stride=2),
+
+            nn.Conv2d(64, 128, kernel_size=3, padding=1),
+            nn.BatchNorm2d(128),
+            nn.ReLU(inplace=True),
+            nn.MaxPool2d(kernel_size=2, stride=2),
+
+            nn.Conv2d(128, 256, kernel_size=3, padding=1),
+            nn.BatchNorm2d(256),
+            nn.ReLU(inplace=True),
+            nn.MaxPool2d(kernel_size=2, stride=2),
+
+            nn.Conv2d(256, 512, kernel_size=3, padding=1),
+            nn.BatchNorm2d(512),
+            nn.ReLU(inplace=True),
+            nn.MaxPool2d(kernel_size=2, stride=2),
+
+            nn.Flatten()
+        )
+        self.fcl = nn.Sequential(
+            nn.Linear(512 * 14 * 14, 120),
+            nn.ReLU(inplace=True),
+            nn.Linear(120, num_classes),
+            nn.Softmax(dim=1)
+        )
+    def forward(self, x):
+        x = self.convolutions(x)
+        x = self.fcl(x)
+        return x
+
+MEAN = (0.485, 0.456, 0.406)
+STD = (0.229, 0.224, 0.225)
+
+"""
+Batched equivalent of tf for images that are already padded (CachedCountriesDataset):
+uint8 -> float, normalize, and keep the pad border at 0 as transforms.Pad does after Normalize.
+"""
+class BatchNormalize():
+    def __init__(self, pad=1, mean=MEAN, std=STD):
+        self.pad = pad
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+
+    def __call__(self, X_batch):
+        mean, std = self.mean.to(X_batch.device), self.std.to(X_batch.device)
+        X_batch = X_batch.float().div_(255).sub_(mean).div_(std)
+        if self.pad:
+            p = self.pad
+            X_batch[:, :, :p, :] = 0
+            X_batch[:, :, -p:, :] = 0
+            X_batch[:, :, :, :p] = 0
+            X_batch[:, :, :, -p:] = 0
+        return X_batch
+
+"""
+Accumulates wall time per phase. On CUDA the phases are synchronized so the split is meaningful.
+"""
+class PhaseTimer():
+    def __init__(self, device):
+        self.device = device
+        self.totals = {"data": 0.0, "forward": 0.0, "backward": 0.0}
+        self.last = time.perf_counter()
+
+    def mark(self, phase):
+        if self.device == "cuda":
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.totals[phase] += now - self.last
+        metrics.observe(f"train.{phase}", now - self.last)
+        self.last = now
+
+    def summary(self):
+        total = sum(self.totals.values()) or 1.0
+        return "  ".join(f"{phase} {seconds:.1f}s ({seconds / total:.0%})" for phase, seconds in self.totals.items())
+
+def split_indices(df, test_size=0.2, seed=None):
+    # Row positions of the train/test split. Groups (dataset.add_duplicate_groups) never end up on both sides.
+    if "group" in df.columns:
+        return group_split(df, test_size=test_size, seed=seed)
+    return train_test_split(np.arange(len(df)), test_size=test_size, random_state=seed)
+
+def make_loaders(df, batch_size=75, num_workers=0, pin_memory=False, persistent_workers=False,
+                 prefetch_factor=2, test_size=0.2, seed=None, cache_dir=None):
+    """
+    Returns (train_dataloader, test_dataloader, batch_transform). batch_transform is None unless
+    cache_dir is set, in which case the loaders yield padded uint8 batches from the tensor cache
+    and batch_transform (BatchNormalize) must be applied to each batch.
+    """
+    batch_transform = None
+    train_idx, test_idx = split_indices(df, test_size, seed)
+    if cache_dir is not None:
+        build_tensor_cache(df, cache_dir)
+        train_dataset = CachedCountriesDataset(cache_dir, train_idx)
+        test_dataset = CachedCountriesDataset(cache_dir, test_idx)
+        batch_transform = BatchNormalize()
+    else:
+        train_dataset = CustomCountriesDataset(df.iloc[train_idx], transform=tf)
+        test_dataset = CustomCountriesDataset(df.iloc[test_idx], transform=tf)
+
+    loader_kwargs = {"batch_size": batch_size, "num_workers": num_workers, "pin_memory": pin_memory}
+    if num_workers > 0:
+        # Only valid with worker processes.
+        loader_kwargs.update(persistent_workers=persistent_workers, prefetch_factor=prefetch_factor)
+    train_dataloader = DataLoader(train_dataset, shuffle=True, **loader_kwargs)
+    test_dataloader = DataLoader(test_dataset, shuffle=False, **loader_kwargs)
+    return train_dataloader, test_dataloader, batch_transform
+
+def _to_device(X_batch, y_batch, device, channels_last, batch_transform=None):
+    non_blocking = device == "cuda"
+    X_batch = X_batch.to(device, non_blocking=non_blocking)
+    if batch_transform is not None:
+        X_batch = batch_transform(X_batch)
+    if channels_last:
+        X_batch = X_batch.contiguous(memory_format=torch.channels_last)
+    return X_batch, y_batch.to(device, non_blocking=non_blocking)
+
+def train_one_epoch(model, dataloader, criterion, optimizer, device, desc="", update_frequency=10, channels_last=False,
+                    batch_transform=None):
+    model.train()
+    timer = PhaseTimer(device)
+    # Metrics stay on the device; .item() only runs when the progress bar is refreshed.
+    running_loss = torch.zeros((), device=device)
+    correct_predictions = torch.zeros((), dtype=torch.long, device=device)
+    total_train_samples = 0
+    bar = tqdm(dataloader, desc=desc, unit="batch")
+    for i, (X_batch, y_batch) in enumerate(bar):
+        X_batch, y_batch = _to_device(X_batch, y_batch, device, channels_last, batch_transform)
+        timer.mark("data")
+
+        # forward pass
+        pred = model(X_batch)
+        loss = criterion(pred, y_batch)
+        timer.mark("forward")
+
+        # backprop
+        optimizer.zero_grad(set_to_none=True)
+        loss.backward()
+        optimizer.step()
+
+        running_loss += loss.detach() * y_batch.shape[0]
+        correct_predictions += (pred.detach().argmax(dim=1) == y_batch).sum()
+        total_train_samples += y_batch.shape[0]
+        timer.mark("backward")
+        metrics.count("train.samples", y_batch.shape[0])
+
+        if i % update_frequency == 0:
+            bar.set_description(f"{desc} - Loss: {running_loss.item() / total_train_samples:.4f} "
+                                f"Acc: {correct_predictions.item() / total_train_samples:.4f}")
+            timer.last = time.perf_counter()  # don't bill the sync to the next batch's data wait
+
+    curr_train_loss = running_loss.item() / total_train_samples
+    curr_train_acc = correct_predictions.item() / total_train_samples
+    bar.set_description(f"{desc} - Loss: {curr_train_loss:.4f} Acc: {curr_train_acc:.4f}")
+    return curr_train_loss, curr_train_acc, timer
+
+@torch.no_grad()
+def evaluate(model, dataloader, criterion, device, channels_last=False, batch_transform=None):
+    model.eval()
+    running_val_loss = torch.zeros((), device=device)
+    running_val_acc = torch.zeros((), dtype=torch.long, device=device)
+    total_val_samples = 0
+    for X_batch, y_batch in tqdm(dataloader, desc="Validation", unit="batch"):
+        X_batch, y_batch = _to_device(X_batch, y_batch, device, channels_last, batch_transform)
+        val_pred = model(X_batch)
+        running_val_loss += criterion(val_pred, y_batch) * y_batch.shape[0]
+        running_val_acc += (val_pred.argmax(dim=1) == y_batch).sum()
+        total_val_samples += y_batch.shape[0]
+    return running_val_loss.item() / total_val_samples, running_val_acc.item() / total_val_samples
+
+def train(model, train_dataloader, test_dataloader, num_epochs=5, lr=1e-5, weight_decay=0.001,
+          device="cpu", channels_last=False, update_frequency=10, batch_transform=None):
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.AdamW(model.parameters(), lr=lr, weight_decay=weight_decay)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+
+    history = {"train_loss": [], "train_acc": [], "val_loss": [], "val_acc": [], "phases": []}
+    for epoch in range(num_epochs):
+        start = time.perf_counter()
+        train_loss, train_acc, timer = train_one_epoch(model, train_dataloader, criterion, optimizer, device,
+                                                        desc=f"Epoch {epoch+1}/{num_epochs}",
+                                                        update_frequency=update_frequency, channels_last=channels_last,
+                                                        batch_transform=batch_transform)
+        epoch_time = time.perf_counter() - start
+        metrics.observe("train.epoch", epoch_time)
+        with metrics.timer("train.evaluate"):
+            val_loss, val_acc = evaluate(model, test_dataloader, criterion, device, channels_last, batch_transform)
+        print(f"Epoch {epoch+1}/{num_epochs} - Train loss: {train_loss:.4f} acc: {train_acc:.4f} - "
+              f"Validation loss: {val_loss:.4f} acc: {val_acc:.4f}")
+        print(f"  {epoch_time:.1f}s, {len(train_dataloader.dataset) / epoch_time:.1f} images/s - {timer.summary()}")
+        history["train_loss"].append(train_loss)
+        history["train_acc"].append(train_acc)
+        history["val_loss"].append(val_loss)
+        history["val_acc"].append(val_acc)
+        history["phases"].append(dict(timer.totals))
+    return history
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train the country classifier CNN.")
+    parser.add_argument("--csv", default="../output_224.csv", help="Dataset CSV written by dataset.py")
+    parser.add_argument("--num-classes", type=int, default=None, help="Defaults to the number of classes in the CSV.")
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=75)
+    parser.add_argument("--lr", type=float, default=1e-5)
+    parser.add_argument("--weight-decay", type=float, default=0.001)
+    parser.add_argument("--test-size", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--num-workers", type=int, default=0, help="DataLoader worker processes.")
+    parser.add_argument("--pin-memory", action="store_true")
+    parser.add_argument("--persistent-workers", action="store_true")
+    parser.add_argument("--prefetch-factor", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=None, help="torch.set_num_threads for the training process.")
+    parser.add_argument("--interop-threads", type=int, default=None)
+    parser.add_argument("--channels-last", action="store_true")
+    parser.add_argument("--update-frequency", type=int, default=10, help="Progress bar refresh (and host sync) every N batches.")
+    parser.add_argument("--cache-dir", default=None, help="Decode and pad every image once into a uint8 memmap here.")
+    parser.add_argument("--save", default=None, help="Write the trained state_dict here.")
+    parser.add_argument("--metrics", default=None, help="Write per-phase timings here (JSON, plus a .prom next to it).")
+    args = parser.parse_args(argv)
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.interop_threads:
+        torch.set_num_interop_threads(args.interop_threads)
+    if args.seed is not None:
+        torch.manual_seed(args.seed)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"{device}, {torch.get_num_threads()} threads, {args.num_workers} loader workers")
+
+    df = pd.read_csv(args.csv)
+    num_classes = args.num_classes or int(df.iloc[:, 1].max()) + 1
+    train_dataloader, test_dataloader, batch_transform = make_loaders(df, args.batch_size, args.num_workers, args.pin_memory,
+                                                                      args.persistent_workers, args.prefetch_factor,
+                                                                      args.test_size, args.seed, args.cache_dir)
+    model = CNN(num_classes=num_classes, in_channels=3).to(device)
+    history = train(model, train_dataloader, test_dataloader, args.epochs, args.lr, args.weight_decay,
+                    device, args.channels_last, args.update_frequency, batch_transform)
+    if args.save:
+        torch.save(model.state_dict(), args.save)
+        print(f"Saved model to {args.save}")
+    if args.metrics:
+        metrics.write_report(args.metrics)
+    return model, history
+
+if __name__ == "__main__":
+    main()